@@ -0,0 +1,315 @@
+"""
+Fits a Python DDM model to the data of many subjects at once, as an
+alternative to launching cluster_scripts/ddm_Roptim.R once per subject file.
+All the optimizations of all subjects (see fitting.fit_ddm) are queued on a
+single pool of processes, most expensive subjects first, and the fit of each
+subject is written to disk as soon as all its optimizations are done. Run
+from the analysis directory, e.g.
+
+  python -m helpers.ddModels.py_ddm_models.batch_fit \\
+    --data-dir helpers/ddModels/cluster_scripts/sub_data_oneParamAsymmLinear \\
+    --model ddm_model1a --par-names d,sigma,delta,gamma \\
+    --out-path helpers/ddModels/cluster_scripts/optim_out/fitModel1a
+
+The subject files are the ones written by save_sub_data.R. The fitted values
+of all subjects are appended to optim_par.csv in the output directory, and
+the evaluations of each subject are written to optim_iter_sub<subnum>.csv.
+"""
+import argparse
+import csv
+import glob
+import importlib
+import os
+import sys
+import time
+
+from helpers.ddModels.py_ddm_models import fitting
+from helpers.ddModels.py_ddm_models import util
+
+
+def load_subject_data(fileName):
+    """
+    Loads the trials of one subject from a CSV file written by
+    save_sub_data.R. Fields required in the file: subnum, EVLeft, EVRight,
+    QVLeft, QVRight, probFractalDraw, choice (1 for left, 0 for right) and
+    reactionTime (in seconds, or in milliseconds if 100 or more, as in the
+    fit_trial functions of r_ddm_models). Trials with a missing choice or
+    reaction time are skipped.
+    Args:
+      fileName: string, name of the subject file.
+    Returns:
+      A tuple (subnum, trials), with the subject number as a string and a
+          util.TrialTable object with the trials of the subject.
+    """
+    columns = dict((name, list()) for name in (u"subnum",) +
+                   util.TrialTable.columns)
+    try:
+        with open(fileName, u"rt", newline=u"") as csvFile:
+            for row in csv.DictReader(csvFile):
+                if row[u"choice"] in (u"", u"NA") or (
+                        row[u"reactionTime"] in (u"", u"NA")):
+                    continue
+                reactionTime = float(row[u"reactionTime"])
+                if reactionTime < 100:
+                    reactionTime *= 1000
+                columns[u"RT"].append(int(round(reactionTime)))
+                columns[u"choice"].append(
+                    -1 if int(float(row[u"choice"])) == 1 else 1)
+                for name in util.conditionFields:
+                    columns[name].append(float(row[name]))
+                columns[u"subnum"].append(row[u"subnum"])
+    except:
+        print(u"An exception occurred while loading subject file " +
+              fileName + u".")
+        raise
+    if columns[u"subnum"]:
+        subnum = columns[u"subnum"][0]
+    else:
+        subnum = os.path.basename(fileName).split(u"_")[0]
+    return subnum, util.TrialTable(*[columns[name]
+                                     for name in util.TrialTable.columns])
+
+
+def find_subject_files(dataDir, pattern=u"sub*_data.csv"):
+    """
+    Args:
+      dataDir: string, directory with the subject files.
+      pattern: string, glob pattern of the subject file names.
+    Returns:
+      A sorted list with the paths of the subject files.
+    """
+    return sorted(glob.glob(os.path.join(dataDir, pattern)))
+
+
+def estimate_fit_cost(trials, barrier=1, timeStep=10, stateStep=0.1,
+                      propagation=u"dense"):
+    """
+    Estimates the relative cost of one likelihood evaluation of a data set,
+    used to queue the most expensive subjects first.
+    Args:
+      trials: util.TrialTable object.
+      barrier: positive number, magnitude of the signal thresholds.
+      timeStep: integer, value in milliseconds to be used for binning the
+          time axis.
+      stateStep: float, to be used for binning the RDV axis.
+      propagation: string, one of util.propagationMethods.
+    Returns:
+      The estimated cost, see util.schedule_trials.
+    """
+    if len(trials) == 0:
+        return 0.0
+    numStates = util.get_state_grid(barrier, stateStep)[0].size
+    _, _, shardCosts = util.schedule_trials(
+        trials.deduplicate(timeStep=timeStep)[0], 1, timeStep=timeStep,
+        numStates=numStates, propagation=propagation)
+    return float(shardCosts[0])
+
+
+def write_iterations(fileName, parNames, restarts):
+    """
+    Writes the evaluations of all the optimizations of one subject.
+    Args:
+      fileName: string, name of the file to write.
+      parNames: list of strings, names of the fitted parameters.
+      restarts: list with the output of each optimization, see
+          fitting.NegativeLogLikelihood.optimize.
+    """
+    with open(fileName, u"wt", newline=u"") as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow([u"restart", u"iteration"] + list(parNames) +
+                        [u"nll"])
+        for restartIndex, restart in enumerate(restarts):
+            for iteration, row in enumerate(restart[u"iterations"]):
+                writer.writerow([restartIndex + 1, iteration + 1] +
+                                list(row))
+
+
+def fit_subjects(modelClass, fileNames, outPath, parNames=(u"d", u"sigma"),
+                 bounds=None, fixPars=None, numRestarts=8, startVals=None,
+                 method=u"L-BFGS-B", maxIter=500, numThreads=4, seed=None,
+                 timeStep=10, stateStep=0.1, propagation=u"dense",
+                 verbose=False):
+    """
+    Fits a DDM to the data of each subject. Each optimization of each
+    subject is one task of a util.ModelPool that holds the data of all
+    subjects, and the tasks are queued by decreasing estimated cost of the
+    subject, so that the longest fits do not start last. The fit of a subject
+    is written to outPath as soon as all its optimizations are done.
+    Args:
+      modelClass: DDM class of the model to be fitted, e.g. ddm_model1a.DDM.
+      fileNames: list of strings, paths of the subject files (see
+          load_subject_data).
+      outPath: string, directory where the results are written.
+      parNames, bounds, fixPars, numRestarts, startVals, method, maxIter,
+          timeStep, stateStep, propagation: see fitting.fit_ddm.
+      numThreads: int, size of the process pool. With a single thread the
+          fits run in this process.
+      seed: master seed for the random starting points. The starting points
+          of each subject are drawn from its own child stream (see
+          util.get_seed_sequence), so they do not depend on the other
+          subjects.
+      verbose: boolean, whether or not to increase output verbosity.
+    Returns:
+      A dict indexed by subject number with the fit of each subject, see
+          fitting.fit_ddm, plus the wall time in seconds from the start of the
+          batch to the end of the fit ("seconds").
+    """
+    parNames = list(parNames)
+    seed = util.get_seed_sequence(seed)
+    if not os.path.isdir(outPath):
+        os.makedirs(outPath)
+
+    # Set up the optimizations of all subjects. The worker data holds the
+    # unique trials and multiplicities of each subject under its own keys.
+    data = dict()
+    tasks = list()
+    taskSubjects = list()
+    subjectRuns = dict()
+    subjectCosts = dict()
+    for subjectIndex, fileName in enumerate(fileNames):
+        subnum, trials = load_subject_data(fileName)
+        if subnum in subjectRuns:
+            raise ValueError(u"Error: subject " + subnum + u" appears in "
+                             "more than one file.")
+        subjectCosts[subnum] = estimate_fit_cost(
+            trials, barrier=(fixPars or dict()).get(u"barrier", 1),
+            timeStep=timeStep, stateStep=stateStep, propagation=propagation)
+        uniqueTrials, counts, parBounds, runs = (
+            fitting.get_optimization_runs(
+                modelClass, trials, parNames, bounds=bounds, fixPars=fixPars,
+                numRestarts=numRestarts, startVals=startVals,
+                seed=util.get_seed_sequence(seed, subjectIndex),
+                timeStep=timeStep, stateStep=stateStep,
+                propagation=propagation))
+        data[u"trials_" + subnum] = uniqueTrials
+        data[u"counts_" + subnum] = counts
+        subjectRuns[subnum] = len(runs)
+        for run in runs:
+            tasks.append((run, u"run",
+                          [u"trials_" + subnum, u"counts_" + subnum],
+                          dict(bounds=parBounds, method=method,
+                               maxIter=maxIter)))
+            taskSubjects.append(subnum)
+        if verbose:
+            print(u"Subject " + subnum + u": " + str(len(trials)) +
+                  u" trials, " + str(len(uniqueTrials)) + u" unique.")
+
+    order = sorted(range(len(tasks)),
+                   key=lambda i: -subjectCosts[taskSubjects[i]])
+    tasks = [tasks[taskIndex] for taskIndex in order]
+    taskSubjects = [taskSubjects[taskIndex] for taskIndex in order]
+
+    fits = dict()
+    restarts = dict((subnum, list()) for subnum in subjectRuns)
+    start = time.perf_counter()
+    parFileName = os.path.join(outPath, u"optim_par.csv")
+    with open(parFileName, u"wt", newline=u"") as parFile:
+        parWriter = csv.writer(parFile)
+        parWriter.writerow([u"subnum"] + parNames +
+                           [u"nll", u"success", u"numEvaluations",
+                            u"seconds"])
+        parFile.flush()
+
+        def record(taskIndex, restart):
+            subnum = taskSubjects[taskIndex]
+            restarts[subnum].append(restart)
+            if len(restarts[subnum]) < subjectRuns[subnum]:
+                return
+            fit = fitting.summarize_restarts(restarts[subnum])
+            fit[u"seconds"] = time.perf_counter() - start
+            fits[subnum] = fit
+            write_iterations(
+                os.path.join(outPath, u"optim_iter_sub" + subnum + u".csv"),
+                parNames, fit[u"restarts"])
+            parWriter.writerow(
+                [subnum] + [fit[u"par"][name] for name in parNames] +
+                [fit[u"nll"], fit[u"restarts"][0][u"success"],
+                 fit[u"numEvaluations"], fit[u"seconds"]])
+            parFile.flush()
+            if verbose:
+                print(u"Subject " + subnum + u": " + str(fit[u"par"]) +
+                      u", NLL = " + str(fit[u"nll"]) + u" (" +
+                      str(len(fits)) + u"/" + str(len(subjectRuns)) +
+                      u" subjects done).")
+
+        try:
+            if numThreads > 1:
+                with util.ModelPool(numThreads, **data) as pool:
+                    for taskIndex, restart in pool.imap_unordered(tasks):
+                        record(taskIndex, restart)
+                    if verbose:
+                        for pid, (busyTime, idleTime) in sorted(
+                                pool.get_worker_times().items()):
+                            print(u"Worker " + str(pid) + u": busy " +
+                                  str(round(busyTime, 2)) + u" s, idle " +
+                                  str(round(idleTime, 2)) + u" s.")
+            else:
+                for taskIndex, (run, methodName, argNames, kwargs) in (
+                        enumerate(tasks)):
+                    record(taskIndex, getattr(run, methodName)(
+                        *[data[name] for name in argNames], **kwargs))
+        except:
+            print(u"An exception occurred while fitting the subjects.")
+            raise
+    return fits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=u"Fit a Python DDM model to the data of many subjects.")
+    parser.add_argument(u"--data-dir", required=True,
+                        help=u"Directory with the subject files written by "
+                             "save_sub_data.R.")
+    parser.add_argument(u"--pattern", default=u"sub*_data.csv",
+                        help=u"Glob pattern of the subject file names.")
+    parser.add_argument(u"--model", default=u"ddm_model1a",
+                        help=u"Name of the model module, e.g. ddm_model1.")
+    parser.add_argument(u"--par-names", default=u"d,sigma")
+    parser.add_argument(u"--fix-par-names", default=u"none")
+    parser.add_argument(u"--fix-par-vals", default=u"none")
+    parser.add_argument(u"--start-vals", default=None,
+                        help=u"Comma separated starting values, used by the "
+                             "first optimization of every subject.")
+    parser.add_argument(u"--num-restarts", type=int, default=8)
+    parser.add_argument(u"--method", default=u"L-BFGS-B")
+    parser.add_argument(u"--max-iter", type=int, default=500)
+    parser.add_argument(u"--num-threads", type=int, default=4)
+    parser.add_argument(u"--seed", type=int, default=None)
+    parser.add_argument(u"--time-step", type=int, default=10)
+    parser.add_argument(u"--state-step", type=float, default=0.1)
+    parser.add_argument(u"--propagation", default=u"dense",
+                        choices=util.propagationMethods)
+    parser.add_argument(u"--out-path", required=True,
+                        help=u"Directory where the results are written.")
+    parser.add_argument(u"--verbose", action=u"store_true")
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(u"helpers.ddModels.py_ddm_models." +
+                                     args.model)
+    parNames = [name.strip() for name in args.par_names.split(u",")]
+    fixPars = dict()
+    if args.fix_par_names != u"none":
+        fixPars = dict(zip(
+            [name.strip() for name in args.fix_par_names.split(u",")],
+            [float(val) for val in args.fix_par_vals.split(u",")]))
+    startVals = None
+    if args.start_vals:
+        startVals = [float(val) for val in args.start_vals.split(u",")]
+
+    fileNames = find_subject_files(args.data_dir, args.pattern)
+    if not fileNames:
+        print(u"No subject files found in " + args.data_dir + u".")
+        return 1
+    fits = fit_subjects(
+        module.DDM, fileNames, args.out_path, parNames=parNames,
+        fixPars=fixPars, numRestarts=args.num_restarts, startVals=startVals,
+        method=args.method, maxIter=args.max_iter,
+        numThreads=args.num_threads, seed=args.seed,
+        timeStep=args.time_step, stateStep=args.state_step,
+        propagation=args.propagation, verbose=args.verbose)
+    print(u"Fitted " + str(len(fits)) + u" subjects.")
+    return 0
+
+
+if __name__ == u"__main__":
+    sys.exit(main())
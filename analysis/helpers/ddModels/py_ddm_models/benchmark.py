@@ -0,0 +1,291 @@
+"""
+Benchmarks for the likelihood and simulation hot paths of the Python DDM
+models. Results are written as JSON and can be compared against a stored
+baseline. Run from the analysis directory, e.g.
+
+  python -m helpers.ddModels.py_ddm_models.benchmark --output bench.json
+  python -m helpers.ddModels.py_ddm_models.benchmark --baseline bench.json
+
+The second command exits with a non-zero status if any scenario is slower, or
+uses more memory, than the baseline by more than the given tolerance. The
+peak memory of a scenario is only traced in the benchmarking process, so the
+scenarios that compute in a pool of worker processes are marked "parentOnly"
+and left out of the peak memory comparison; the memory of the workers is
+covered by the max RSS of the child processes instead.
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from helpers.ddModels.py_ddm_models import util
+
+
+# Parameters used to build the benchmarked models, by model module.
+modelParams = {
+    u"ddm_model1": (0.05, 0.08),
+    u"ddm_model1a": (0.05, 0.08, 1.2, 0.8),
+}
+
+
+def make_trial_conditions_file(fileName, numConditions=8, seed=0):
+    """
+    Writes synthetic trial conditions to a CSV file, with the same fields as
+    test_trial_conditions.csv.
+    Args:
+      fileName: string, name of the file to write.
+      numConditions: integer, number of trial conditions.
+      seed: seed for the random number generator.
+    """
+    rng = np.random.default_rng(seed)
+    probFractalDraw = np.linspace(0, 1, numConditions)
+    with open(fileName, u"wt", newline=u"") as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(util.conditionFields)
+        for p in probFractalDraw:
+            writer.writerow([round(rng.uniform(0, 1), 3),
+                             round(rng.uniform(0, 1), 3),
+                             round(rng.uniform(-1, 1), 3),
+                             round(rng.uniform(-1, 1), 3),
+                             round(p, 3)])
+
+
+def time_call(func, repeats):
+    """
+    Times a function call.
+    Args:
+      func: function without arguments.
+      repeats: integer, number of timed calls.
+    Returns:
+      A tuple (seconds, peakBytes) with the median time of the calls in seconds
+          and the peak memory allocated by Python during the first call.
+    """
+    tracemalloc.start()
+    func()
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), int(peakBytes)
+
+
+def run_benchmarks(modelName, trialsFileName, repeats=3, quick=False,
+                   numThreads=2):
+    """
+    Runs all benchmark scenarios for one model.
+    Args:
+      modelName: string, name of the model module, e.g. "ddm_model1".
+      trialsFileName: string, path of trial conditions file.
+      repeats: integer, number of timed calls per scenario.
+      quick: boolean, whether to use smaller problem sizes.
+      numThreads: int, size of the pool used in the recovery scenarios.
+    Returns:
+      A dict indexed by scenario name, where each entry is a dict with the
+          scenario time ("seconds"), throughput ("itemsPerSecond"), peak
+          Python memory of this process ("peakBytes"), and whether most of
+          the work is done in child processes, whose memory is not included
+          in peakBytes ("parentOnly"). The single-trial scenarios and the
+          batch scenarios with a state step of 0.01 start from an empty
+          kernel cache on every call, so they include building the
+          transition kernels, while the other scenarios reuse the cached
+          kernels.
+    """
+    module = importlib.import_module(u"helpers.ddModels.py_ddm_models." +
+                                     modelName)
+    params = modelParams[modelName]
+    model = module.DDM(*params)
+    trialConditions = util.load_trial_conditions_from_csv(trialsFileName,
+                                                          useCache=False)
+    results = dict()
+
+    def record(name, func, numItems, parentOnly=False, coldKernels=False):
+        # With coldKernels, the kernel cache is cleared before every call, so
+        # that the building of the transition kernels is timed too.
+        timedFunc = func
+        if coldKernels:
+            def timedFunc():
+                util.defaultKernelCache.clear()
+                return func()
+        seconds, peakBytes = time_call(timedFunc, repeats)
+        results[name] = {u"seconds": seconds,
+                         u"itemsPerSecond": numItems / seconds,
+                         u"peakBytes": peakBytes,
+                         u"parentOnly": parentOnly}
+
+    # Single-trial likelihood at several RT lengths and state steps.
+    condition = trialConditions[len(trialConditions) // 2]
+    RTs = (500, 2000) if quick else (500, 2000, 8000)
+    stateSteps = (0.1, 0.05) if quick else (0.1, 0.05, 0.01)
+    for RT in RTs:
+        for stateStep in stateSteps:
+            trial = util.TrialTable([RT], [-1], *[[value]
+                                                  for value in condition])[0]
+            record(u"trial_likelihood_rt%d_step%g" % (RT, stateStep),
+                   lambda: model.get_trial_likelihood(
+                       trial, approxStateStep=stateStep), 1,
+                   coldKernels=True)
+
+    # Batch likelihood and batch simulation throughput.
+    numSimulations = 100 if quick else 1000
+    RTs, choices = model.simulate_trials(trialConditions, numSimulations,
+                                         seed=0)
+    trials = util.TrialTable.from_simulation(trialConditions, RTs, choices)
+    record(u"batch_likelihood",
+           lambda: model.get_trials_likelihood_batch(trials), len(trials))
+    for propagation in (u"dense", u"direct", u"fft"):
+        record(u"batch_likelihood_%s_step0.01" % propagation,
+               lambda: model.get_trials_likelihood_batch(
+                   trials, approxStateStep=0.01, propagation=propagation),
+               len(trials), coldKernels=True)
+    record(u"batch_simulation",
+           lambda: model.simulate_trials(trialConditions, numSimulations,
+                                         seed=0),
+           len(trialConditions) * numSimulations)
+
+    # Full recovery grids on the synthetic conditions. Their likelihoods are
+    # computed in a pool of worker processes.
+    rangeD = [0.03, 0.05, 0.07]
+    rangeSigma = [0.06, 0.08]
+    numModels = len(rangeD) * len(rangeSigma)
+    record(u"recover_pars_pta",
+           lambda: module.recover_pars_pta(
+               params[0], params[1], rangeD, rangeSigma,
+               trialsFileName=trialsFileName,
+               trialsPerCondition=20 if quick else 100,
+               numThreads=numThreads), numModels, parentOnly=True)
+    record(u"recover_pars_mla",
+           lambda: module.recover_pars_mla(
+               params[0], params[1], rangeD, rangeSigma,
+               trialsFileName=trialsFileName, numTrials=20 if quick else 100,
+               numSimulations=50 if quick else 500, numThreads=numThreads),
+           numModels, parentOnly=True)
+    return results
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Compares a benchmark report against a baseline report.
+    Args:
+      report: dict, benchmark report.
+      baseline: dict, baseline benchmark report.
+      tolerance: float, allowed relative loss of throughput, and relative
+          increase of memory, before a scenario counts as a regression. The
+          peak memory of scenarios marked "parentOnly" is not compared.
+    Returns:
+      A list of strings describing each regression.
+    """
+    regressions = list()
+    for modelName, results in report[u"results"].items():
+        baseResults = baseline[u"results"].get(modelName, dict())
+        for name, result in results.items():
+            if name not in baseResults:
+                continue
+            base = baseResults[name]
+            ratio = result[u"itemsPerSecond"] / base[u"itemsPerSecond"]
+            if ratio < 1 - tolerance:
+                regressions.append(
+                    u"%s %s: throughput %.3g/s vs baseline %.3g/s" %
+                    (modelName, name, result[u"itemsPerSecond"],
+                     base[u"itemsPerSecond"]))
+            if result.get(u"parentOnly") or base.get(u"parentOnly"):
+                continue
+            if result[u"peakBytes"] > (1 + tolerance) * base[u"peakBytes"]:
+                regressions.append(
+                    u"%s %s: peak memory %d bytes vs baseline %d bytes" %
+                    (modelName, name, result[u"peakBytes"],
+                     base[u"peakBytes"]))
+    if report[u"maxRSSKilobytes"] > ((1 + tolerance) *
+                                     baseline[u"maxRSSKilobytes"]):
+        regressions.append(u"max RSS %d kB vs baseline %d kB" %
+                           (report[u"maxRSSKilobytes"],
+                            baseline[u"maxRSSKilobytes"]))
+    if (u"maxChildRSSKilobytes" in baseline and
+            report[u"maxChildRSSKilobytes"] > (
+                (1 + tolerance) * baseline[u"maxChildRSSKilobytes"])):
+        regressions.append(u"max RSS of child processes %d kB vs baseline "
+                           "%d kB" % (report[u"maxChildRSSKilobytes"],
+                                      baseline[u"maxChildRSSKilobytes"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=u"Benchmark the Python DDM likelihood and simulation "
+                    "hot paths.")
+    parser.add_argument(u"--models", nargs=u"+", default=sorted(modelParams),
+                        choices=sorted(modelParams))
+    parser.add_argument(u"--trials-file-name", default=None,
+                        help=u"Trial conditions file. Synthetic conditions "
+                             "are generated if not given.")
+    parser.add_argument(u"--repeats", type=int, default=3)
+    parser.add_argument(u"--num-threads", type=int, default=2)
+    parser.add_argument(u"--quick", action=u"store_true",
+                        help=u"Use smaller problem sizes.")
+    parser.add_argument(u"--output", default=None,
+                        help=u"JSON file to write the results to.")
+    parser.add_argument(u"--baseline", default=None,
+                        help=u"JSON file with baseline results to compare "
+                             "against.")
+    parser.add_argument(u"--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        trialsFileName = args.trials_file_name
+        if not trialsFileName:
+            trialsFileName = os.path.join(tempDir, u"trial_conditions.csv")
+            make_trial_conditions_file(trialsFileName)
+        results = dict()
+        for modelName in args.models:
+            results[modelName] = run_benchmarks(
+                modelName, trialsFileName, repeats=args.repeats,
+                quick=args.quick, numThreads=args.num_threads)
+    finally:
+        shutil.rmtree(tempDir)
+
+    report = {
+        u"python": platform.python_version(),
+        u"numpy": np.__version__,
+        u"platform": platform.platform(),
+        u"quick": args.quick,
+        # ru_maxrss is reported in kilobytes on Linux. For the children it
+        # is the largest RSS of any terminated worker process.
+        u"maxRSSKilobytes": resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss,
+        u"maxChildRSSKilobytes": resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss,
+        u"results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, u"wt") as outFile:
+            outFile.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, u"rt") as baseFile:
+            baseline = json.load(baseFile)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(u"Regression: " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == u"__main__":
+    sys.exit(main())
@@ -1,7 +1,7 @@
-from helpers.ddmSims.py_ddm_models.util import load_trial_conditions_from_csv
+from helpers.ddModels.py_ddm_models import fitting
+from helpers.ddModels.py_ddm_models import util
+from helpers.ddModels.py_ddm_models.util import load_trial_conditions_from_csv
 import numpy as np
-from multiprocessing import Pool
-from scipy.stats import norm
 
 class DDMTrial(object):
     def __init__(self, RT, choice, QVRight, QVLeft, EVRight, EVLeft, probFractalDraw):
@@ -54,17 +54,101 @@ class DDM(object):
         self.params = (d, sigma, delta, gamma)
 
 
-    def get_trial_likelihood(self, trial, timeStep=10, approxStateStep=0.1):
+    def get_weighted_mu(self, QVLeft, QVRight, EVLeft, EVRight,
+                        probFractalDraw):
+        """
+        Computes the mean of the change in RDV per time step, weighting the
+        fractal value difference by the distorted probability of a fractal
+        draw and the lottery value difference by the probability of a lottery
+        draw.
+        Args:
+          QVLeft: Q value of the left fractal.
+          QVRight: Q value of the right fractal.
+          EVLeft: expected value of the left lottery.
+          EVRight: expected value of the right lottery.
+          probFractalDraw: probability of the fractal being drawn.
+          All arguments can also be numpy arrays of trial conditions.
+        Returns:
+          The drift rate for the given trial condition(s).
+        """
+        probFractalDraw = np.asarray(probFractalDraw, dtype=float)
+        distortedProbFractalDraw = self.get_distorted_prob(probFractalDraw)
+        leftFractalAdv =  distortedProbFractalDraw * (QVLeft - QVRight)
+        leftLotteryAdv = (1-probFractalDraw) * (EVLeft - EVRight)
+        # Indexing with an empty tuple returns a scalar for scalar inputs.
+        return (self.d * (leftFractalAdv + leftLotteryAdv))[()]
+
+
+    def get_distorted_prob(self, probFractalDraw):
+        """
+        Distorts the probability of a fractal draw with the two-parameter
+        Prelec weighting function exp(-delta * (-log p) ** gamma).
+        Args:
+          probFractalDraw: probability of the fractal being drawn, or numpy
+              array of probabilities.
+        Returns:
+          The distorted probabilities, as a numpy array.
+        """
+        # The probabilities 0 and 1 are not distorted.
+        probFractalDraw = np.asarray(probFractalDraw, dtype=float)
+        with np.errstate(divide=u"ignore", invalid=u"ignore"):
+            return np.where(
+                (probFractalDraw != 0) & (probFractalDraw != 1),
+                np.exp((-1)*self.delta*((-1)*np.log(probFractalDraw))**self.gamma),
+                probFractalDraw)
+
+
+    def get_condition_means(self, conditions):
+        """
+        Computes the drift rate of compiled trial conditions. The distortion
+        is only evaluated for the distinct probabilities of a fractal draw,
+        and both the distorted probabilities of each (delta, gamma) and the
+        drift rates of each (d, delta, gamma) are cached by the table, so
+        that models sharing these parameters, e.g. a grid over sigma, reuse
+        them.
+        Args:
+          conditions: util.ConditionTable object.
+        Returns:
+          A numpy array with the drift rate of each trial condition.
+        """
+        def compute_means():
+            distortedProbValues = conditions.get_cached(
+                (__name__, u"distortion", self.delta, self.gamma),
+                lambda: self.get_distorted_prob(conditions.probValues))
+            return self.d * (
+                distortedProbValues[conditions.probIndex] *
+                conditions.fractalDiff +
+                (1 - conditions.probFractalDraw) * conditions.lotteryDiff)
+
+        return conditions.get_cached(
+            (__name__, u"means", self.d, self.delta, self.gamma),
+            compute_means)
+
+
+    def get_trial_likelihood(self, trial, timeStep=10, approxStateStep=0.1,
+                             kernelCache=None, propagation=u"dense",
+                             tailTolerance=1e-12):
         """
         Computes the likelihood of the data from a single DDM trial for these
         particular DDM parameters.
         Args:
-          trial: DDMTrial object.
+          trial: DDMTrial object, or a single trial of a util.TrialTable.
           timeStep: integer, value in milliseconds to be used for binning the
               time axis.
           approxStateStep: float, to be used for binning the RDV axis.
-          plotTrial: boolean, flag that determines whether the algorithm
-              evolution for the trial should be plotted.
+          kernelCache: util.KernelCache object holding the transition kernels.
+              Defaults to the cache shared by all models in the process.
+          propagation: string, backend used to propagate the state
+              probabilities, one of util.propagationMethods. "dense" uses the
+              full transition matrix, "direct" and "fft" convolve the states
+              with the 1-D Gaussian kernel, "direct" leaving out the offsets
+              that are negligible in double precision, "banded" convolves with
+              the kernel truncated to a tail tolerance, and "auto" picks
+              "direct" for narrow state grids and "fft" for wide ones (see
+              util.resolve_propagation).
+          tailTolerance: float, kernel mass that may be discarded when
+              propagation is "banded". The discarded mass can be read back
+              with util.KernelCache.get_discarded_mass.
         Returns:
           The likelihood obtained for the given trial and model.
         """
@@ -74,52 +158,43 @@ class DDM(object):
             raise RuntimeError(u"Trial response time is smaller than time "
                                "step.")
 
-        # The values of the barriers can change over time.
-        decay = 0  # decay = 0 means barriers are constant.
-        barrierUp = self.barrier * np.ones(numTimeSteps)
-        barrierDown = -self.barrier * np.ones(numTimeSteps)
-        for t in range(1, numTimeSteps):
-            barrierUp[t] = self.barrier / (1 + (decay * t))
-            barrierDown[t] = -self.barrier / (1 + (decay * t))
-
-        # Obtain correct state step.
-        halfNumStateBins = np.ceil(self.barrier / approxStateStep)
-        stateStep = self.barrier / (halfNumStateBins + 0.5)
-
-        # The vertical axis is divided into states.
-        states = np.arange(barrierDown[0] + (stateStep / 2),
-                           barrierUp[0] - (stateStep / 2) + stateStep,
-                           stateStep)
+        # The vertical axis is divided into states. The barriers are constant
+        # (decay = 0), so the same states are used at every time step.
+        states, stateStep = util.get_state_grid(self.barrier, approxStateStep)
+        outside = (states >= self.barrier) | (states <= -self.barrier)
+        propagation = util.resolve_propagation(propagation, states.size)
 
         # Find the state corresponding to the bias parameter.
         biasState = np.argmin(np.absolute(states - self.bias))
 
-        # Initial probability for all states is zero, except the bias state,
-        # for which the initial probability is one.
-        prStates = np.zeros((states.size, numTimeSteps))
-        prStates[biasState,0] = 1
-
-        # The probability of crossing each barrier over the time of the trial.
-        probUpCrossing = np.zeros(numTimeSteps)
-        probDownCrossing = np.zeros(numTimeSteps)
+        weighted_mu = self.get_weighted_mu(trial.QVLeft, trial.QVRight,
+                                           trial.EVLeft, trial.EVRight,
+                                           trial.probFractalDraw)
+
+        # The transition kernel and the barrier crossing probabilities only
+        # depend on the mean of the change in RDV, which is zero during
+        # non-decision time and constant afterwards. Since the barriers are
+        # constant (decay = 0), both kernels are fetched once per trial.
+        if kernelCache is None:
+            kernelCache = util.defaultKernelCache
+        ndtKernel = kernelCache.get_kernel(0, self.sigma, stateStep,
+                                           self.barrier, states)
+        driftKernel = kernelCache.get_kernel(weighted_mu, self.sigma,
+                                             stateStep, self.barrier, states)
 
-        changeMatrix = np.subtract(states.reshape(states.size, 1), states)
-        changeUp = np.subtract(barrierUp, states.reshape(states.size, 1))
-        changeDown = np.subtract(barrierDown, states.reshape(states.size, 1))
+        # Initial probability for all states is zero, except the bias state,
+        # for which the initial probability is one. Only the probabilities of
+        # the previous and the current time steps are needed, so they are kept
+        # in two buffers that are swapped at every time step.
+        prStatesPrev = np.zeros(states.size)
+        prStatesPrev[biasState] = 1
+        prStatesNew = np.zeros(states.size)
+        tempUpCross = 0
+        tempDownCross = 0
 
         elapsedNDT = 0
 
         # Iterate over the time of this trial.
-        
-        if trial.probFractalDraw != 0 and trial.probFractalDraw != 1:
-            distortedProbFractalDraw = np.exp((-1)*self.delta*((-1)*np.log(trial.probFractalDraw))**self.gamma)
-        else:
-            distortedProbFractalDraw = trial.probFractalDraw
-                
-        leftFractalAdv =  distortedProbFractalDraw * (trial.QVLeft - trial.QVRight)
-        leftLotteryAdv = (1-trial.probFractalDraw) * (trial.EVLeft - trial.EVRight)
-        weighted_mu = self.d * (leftFractalAdv + leftLotteryAdv)
-        
         for time in range(1, numTimeSteps):
             # We use a normal distribution to model changes in RDV
             # stochastically. The mean of the distribution (the change most
@@ -127,151 +202,296 @@ class DDM(object):
             # from the item values, except during non-decision time, in which
             # the mean is zero.
             if elapsedNDT < self.nonDecisionTime // timeStep:
-                mean = 0
+                kernel = ndtKernel
                 elapsedNDT += 1
             else:
-                mean = weighted_mu
+                kernel = driftKernel
 
             # Update the probability of the states that remain inside the
             # barriers. The probability of being in state B is the sum, over
             # all states A, of the probability of being in A at the previous
-            # time step times the probability of changing from A to B. We
-            # multiply the probability by the stateStep to ensure that the area
-            # under the curves for the probability distributions probUpCrossing
-            # and probDownCrossing add up to 1.
-            prStatesNew = (stateStep *
-                           np.dot(norm.pdf(changeMatrix, mean, self.sigma),
-                           prStates[:,time-1]))
-            prStatesNew[(states >= barrierUp[time]) |
-                        (states <= barrierDown[time])] = 0
+            # time step times the probability of changing from A to B. The
+            # kernel is multiplied by the stateStep to ensure that the area
+            # under the curves for the probability distributions of crossing
+            # the barriers add up to 1.
+            kernel.propagate(prStatesPrev, propagation, out=prStatesNew,
+                             tailTolerance=tailTolerance)
+            prStatesNew[outside] = 0
 
             # Calculate the probabilities of crossing the up barrier and the
             # down barrier. This is given by the sum, over all states A, of the
             # probability of being in A at the previous timestep times the
             # probability of crossing the barrier if A is the previous state.
-            tempUpCross = np.dot(
-                prStates[:,time-1],
-                (1 - norm.cdf(changeUp[:, time], mean, self.sigma)))
-            tempDownCross = np.dot(
-                prStates[:,time-1],
-                norm.cdf(changeDown[:, time], mean, self.sigma))
+            tempUpCross = np.dot(prStatesPrev, kernel.upCrossing)
+            tempDownCross = np.dot(prStatesPrev, kernel.downCrossing)
 
             # Renormalize to cope with numerical approximations.
-            sumIn = np.sum(prStates[:,time-1])
+            sumIn = np.sum(prStatesPrev)
             sumCurrent = np.sum(prStatesNew) + tempUpCross + tempDownCross
-            prStatesNew = prStatesNew * sumIn / sumCurrent
+            prStatesNew *= sumIn
+            prStatesNew /= sumCurrent
             tempUpCross = tempUpCross * sumIn / sumCurrent
             tempDownCross = tempDownCross * sumIn / sumCurrent
 
-            # Update the probabilities of each state and the probabilities of
-            # crossing each barrier at this timestep.
-            prStates[:, time] = prStatesNew
-            probUpCrossing[time] = tempUpCross
-            probDownCrossing[time] = tempDownCross
+            prStatesPrev, prStatesNew = prStatesNew, prStatesPrev
 
         # Compute the likelihood contribution of this trial based on the final
         # choice.
         likelihood = 0
         if trial.choice == -1:  # Choice was left.
-            if probUpCrossing[-1] > 0:
-                likelihood = probUpCrossing[-1]
+            if tempUpCross > 0:
+                likelihood = tempUpCross
         elif trial.choice == 1:  # Choice was right.
-            if probDownCrossing[-1] > 0:
-                likelihood = probDownCrossing[-1]
+            if tempDownCross > 0:
+                likelihood = tempDownCross
 
 
         return likelihood
     
+    def get_trials_likelihood_batch(self, trials, timeStep=10,
+                                    approxStateStep=0.1, kernelCache=None,
+                                    propagation=u"dense", tailTolerance=1e-12):
+        """
+        Computes the likelihood of the data from a set of DDM trials for these
+        particular DDM parameters. The forward recursion is run once per trial
+        condition, up to the longest RT observed for that condition, with the
+        state probabilities of all conditions advanced together by one matrix
+        product per time step (see get_condition_crossing_probabilities). The
+        likelihood of each trial is then looked up at its own RT.
+        Args:
+          trials: util.TrialTable object or list of DDMTrial objects.
+          timeStep: integer, value in milliseconds to be used for binning the
+              time axis.
+          approxStateStep: float, to be used for binning the RDV axis.
+          kernelCache: util.KernelCache object holding the transition kernels.
+              Defaults to the cache shared by all models in the process.
+          propagation, tailTolerance: see get_trial_likelihood.
+        Returns:
+          A numpy array with the likelihood obtained for each trial.
+        """
+        trials = util.TrialTable.from_trials(trials)
+        numTimeSteps = trials.RT // timeStep
+        if np.any(numTimeSteps < 1):
+            raise RuntimeError(u"Trial response time is smaller than time "
+                               "step.")
+        conditions, conditionIndex = trials.group_by_condition()
+        maxRTs = np.zeros(len(conditions), dtype=int)
+        np.maximum.at(maxRTs, conditionIndex, trials.RT)
+
+        probUpCrossing, probDownCrossing = (
+            self.get_condition_crossing_probabilities(
+                trials.compile(), maxRTs, timeStep=timeStep,
+                approxStateStep=approxStateStep, kernelCache=kernelCache,
+                propagation=propagation, tailTolerance=tailTolerance))
+        return util.get_likelihoods_from_crossings(
+            probUpCrossing, probDownCrossing, conditionIndex, numTimeSteps,
+            trials.choice)
+
+
+    def get_condition_crossing_probabilities(self, conditions, maxRT,
+                                             timeStep=10,
+                                             approxStateStep=0.1,
+                                             kernelCache=None,
+                                             propagation=u"dense",
+                                             tailTolerance=1e-12):
+        """
+        Runs the forward recursion of the state probabilities once per trial
+        condition, up to maxRT, and records the probabilities of crossing each
+        barrier at every time step. The likelihood of any trial of a condition
+        is then a lookup at RT // timeStep - 1 in these arrays.
+        Args:
+          conditions: util.ConditionTable object, or C x 5 array or list of
+              trial conditions, where each trial condition has format
+              (QVLeft, QVRight, EVLeft, EVRight, probFractalDraw).
+          maxRT: integer or array of C integers, largest response time in
+              milliseconds to be covered, for all or for each condition.
+          timeStep: integer, value in milliseconds to be used for binning the
+              time axis.
+          approxStateStep: float, to be used for binning the RDV axis.
+          kernelCache: util.KernelCache object holding the transition kernels.
+              Defaults to the cache shared by all models in the process.
+          propagation, tailTolerance: see get_trial_likelihood.
+        Returns:
+          A tuple (probUpCrossing, probDownCrossing) of C x T numpy arrays,
+              where T is the number of time steps for the largest maxRT.
+              Entry [c, t] is the probability of crossing the up (left
+              choice) or down (right choice) barrier at time step t for
+              condition c.
+        """
+        conditions = util.ConditionTable.from_conditions(conditions)
+        numTimeSteps = np.broadcast_to(np.asarray(maxRT) // timeStep,
+                                       (len(conditions),))
+        return util.get_crossing_probabilities_batch(
+            self.get_condition_means(conditions), numTimeSteps, self.sigma,
+            self.barrier, bias=self.bias,
+            numNDTSteps=self.nonDecisionTime // timeStep,
+            approxStateStep=approxStateStep, kernelCache=kernelCache,
+            propagation=propagation, tailTolerance=tailTolerance)
+
+
+    def get_trials_log_likelihood(self, trials, counts=None, timeStep=10,
+                                  approxStateStep=0.1, kernelCache=None,
+                                  propagation=u"dense", tailTolerance=1e-12):
+        """
+        Computes the log-likelihood of a set of DDM trials, in total and per
+        trial condition, so that workers can return a few numbers instead of
+        one likelihood per trial.
+        Args:
+          trials: util.TrialTable object or list of DDMTrial objects.
+          counts: numpy array with the number of times each trial occurs in
+              the data set, as returned by util.TrialTable.deduplicate. Each
+              trial counts once if not given.
+          timeStep, approxStateStep, kernelCache, propagation, tailTolerance:
+              see get_trials_likelihood_batch.
+        Returns:
+          A tuple (logLikelihood, conditions, conditionLogLikelihoods), where
+              conditions is a K x 5 numpy array with the unique trial
+              conditions and conditionLogLikelihoods a numpy array with the
+              log-likelihood of the trials of each condition. Trials with
+              likelihood zero give -inf.
+        """
+        trials = util.TrialTable.from_trials(trials)
+        likelihoods = self.get_trials_likelihood_batch(
+            trials, timeStep=timeStep, approxStateStep=approxStateStep,
+            kernelCache=kernelCache, propagation=propagation,
+            tailTolerance=tailTolerance)
+        with np.errstate(divide=u"ignore"):
+            logLikelihoods = np.log(likelihoods)
+        if counts is not None:
+            logLikelihoods = counts * logLikelihoods
+        conditions, conditionIndex = trials.group_by_condition()
+        conditionLogLikelihoods = np.bincount(conditionIndex,
+                                              weights=logLikelihoods,
+                                              minlength=len(conditions))
+        return (float(np.sum(logLikelihoods)), conditions,
+                conditionLogLikelihoods)
+
+
+    def get_trials_likelihood_analytic(self, trials, timeStep=10,
+                                       errorTolerance=1e-10,
+                                       approxStateStep=0.1, kernelCache=None,
+                                       propagation=u"dense"):
+        """
+        Computes the likelihood of the data from a set of DDM trials from the
+        series expansion of the Wiener first passage time density (see
+        util.get_likelihoods_analytic), which takes a few microseconds per
+        trial regardless of its RT. The series assumes that the drift is
+        constant from the start of the trial, so models with a non-decision
+        time of at least one time step fall back to
+        get_trials_likelihood_batch. Against the discretized engine with
+        approxStateStep=0.01, the likelihoods agree to about 1% of the peak
+        of the RT distribution when decisions take a few dozen time steps or
+        more, and to within 10% when most decisions take only a handful.
+        Args:
+          trials: util.TrialTable object or list of DDMTrial objects.
+          timeStep: integer, value in milliseconds to be used for binning the
+              time axis.
+          errorTolerance: float, bound on the truncation error of the series.
+          approxStateStep, kernelCache, propagation: used by the discretized
+              engine when falling back, see get_trials_likelihood_batch.
+        Returns:
+          A numpy array with the likelihood obtained for each trial.
+        """
+        if self.nonDecisionTime // timeStep > 0:
+            return self.get_trials_likelihood_batch(
+                trials, timeStep=timeStep, approxStateStep=approxStateStep,
+                kernelCache=kernelCache, propagation=propagation)
+
+        trials = util.TrialTable.from_trials(trials)
+        numTimeSteps = trials.RT // timeStep
+        if np.any(numTimeSteps < 1):
+            raise RuntimeError(u"Trial response time is smaller than time "
+                               "step.")
+        _, conditionIndex = trials.group_by_condition()
+        means = self.get_condition_means(trials.compile())
+        return util.get_likelihoods_analytic(
+            means[conditionIndex], numTimeSteps, trials.choice,
+            self.sigma, self.barrier, bias=self.bias,
+            errorTolerance=errorTolerance)
+
+
     def get_model_log_likelihood(self, trialConditions, numSimulations,
-                                 histBins, dataHistLeft, dataHistRight):
+                                 histBins, dataHistLeft, dataHistRight=None,
+                                 seed=None, commonRandomNumbers=False):
         """
         Computes the log-likelihood of a data set given the model. Data set is
         provided in the form of response time histograms conditioned on choice.
+        All trial conditions are simulated at once and binned with a single
+        np.bincount, and the log-likelihood is obtained from one vectorized
+        reduction over conditions, bins and choices.
         Args:
-          trialConditions: list of pairs corresponding to the different trial
-              conditions. Each pair contains the values of left and right
-              items.
+          trialConditions: list of trial conditions, where each trial
+              condition is a tuple with format (QVLeft, QVRight, EVLeft,
+              EVRight, probFractalDraw).
           numSimulations: integer, number of simulations per trial condition to
               be generated when creating response time histograms.
           histBins: list of numbers corresponding to the time bins used to
               create the response time histograms.
-          dataHistLeft: dict indexed by trial condition (where each trial
-              condition is a pair (valueLeft, valueRight)). Each entry is a
+          dataHistLeft: dict indexed by trial condition. Each entry is a
               numpy array corresponding to the response time histogram
               conditioned on left choice for the data. It is assumed that this
               histogram was created using the same time bins as argument
-              histBins.
+              histBins. Alternatively, a C x B x 2 numpy array with the data
+              histograms of all trial conditions, in the order of
+              trialConditions, as built once per data set by
+              util.get_rt_histograms or util.build_data_histograms. In that
+              case dataHistRight is not used.
           dataHistRight: same as dataHistLeft, except that the response time
               histograms are conditioned on right choice.
+          seed: seed for the random number generator used in the simulations.
+          commonRandomNumbers: boolean, whether to reuse the same
+              standardized noise, derived from seed, for every model (see
+              simulate_trials). Differences between the log-likelihoods of
+              models evaluated with the same seed then reflect their
+              parameters rather than Monte-Carlo noise.
           Returns:
               The log-likelihood for the data given the model.
         """
-        logLikelihood = 0
-        for trialCondition in trialConditions:
-            RTsLeft = list()
-            RTsRight = list()
-            sim = 0
-            while sim < numSimulations:
-                try:
-                    ddmTrial = self.simulate_trial(trialCondition[0],trialCondition[1],trialCondition[2],trialCondition[3],trialCondition[4])
-                except:
-                    print(u"An exception occurred while generating "
-                          "artificial trial " + str(sim) + u" for condition " +
-                          str(trialCondition[0]) + u", " +
-                          str(trialCondition[1]) + u", during the " +
-                          u"log-likelihood computation for model " +
-                          str(self.params) + u".")
-                    raise
-                if ddmTrial.choice == -1:
-                    RTsLeft.append(ddmTrial.RT)
-                elif ddmTrial.choice == 1:
-                    RTsRight.append(ddmTrial.RT)
-                sim += 1
-
-            simulLeft = np.histogram(RTsLeft, bins=histBins)[0]
-            if np.sum(simulLeft) != 0:
-                simulLeft = simulLeft / np.sum(simulLeft)
-            with np.errstate(divide=u"ignore"):
-                logSimulLeft = np.where(simulLeft > 0, np.log(simulLeft), 0)
-            dataLeft = np.array(dataHistLeft[trialCondition])
-            logLikelihood += np.dot(logSimulLeft, dataLeft)
-
-            simulRight = np.histogram(RTsRight, bins=histBins)[0]
-            if np.sum(simulRight) != 0:
-                simulRight = simulRight / np.sum(simulRight)
-            with np.errstate(divide=u"ignore"):
-                logSimulRight = np.where(simulRight > 0, np.log(simulRight), 0)
-            dataRight = np.array(dataHistRight[trialCondition])
-            logLikelihood += np.dot(logSimulRight, dataRight)
-
-        return logLikelihood
+        if isinstance(dataHistLeft, dict):
+            dataHists = util.build_data_histograms(trialConditions,
+                                                   dataHistLeft, dataHistRight)
+        else:
+            dataHists = dataHistLeft
+
+        try:
+            RTs, choices = self.simulate_trials(
+                trialConditions, numSimulations, seed=seed,
+                commonRandomNumbers=commonRandomNumbers)
+        except:
+            print(u"An exception occurred while generating artificial "
+                  "trials during the log-likelihood computation for model " +
+                  str(self.params) + u".")
+            raise
+        conditionIndex = np.repeat(np.arange(len(trialConditions)),
+                                   numSimulations)
+        simulHists = util.get_rt_histograms(conditionIndex, RTs, choices,
+                                            len(trialConditions), histBins)
+        return util.get_histogram_log_likelihood(simulHists, dataHists)
 
 
     def parallel_get_likelihoods(self, ddmTrials, timeStep=10, stateStep=0.1,
-                                 numThreads=4):
+                                 numThreads=4, pool=None,
+                                 propagation=u"dense", tailTolerance=1e-12,
+                                 deduplicate=True, reduce=False,
+                                 schedule=u"cost", shardBounds=None):
         """
-        Uses a threadpool to compute the likelihood of the data from a set of
-        DDM trials given the DDM parameters.
-        Args:
-          ddmTrials: list of DDMTrial objects.
-          timeStep: integer, value in milliseconds to be used for binning the
-              time axis.
-          stateStep: float, to be used for binning the RDV axis.
-          numThreads: int, number of threads to be used in the threadpool.
+        Uses a pool of processes to compute the likelihood of the data from a
+        set of DDM trials given the DDM parameters. See
+        util.parallel_get_likelihoods for the arguments.
         Returns:
-          A list of likelihoods obtained for the given trials and model.
+          A numpy array of likelihoods obtained for the given trials and model,
+              or a tuple (logLikelihood, conditionLogLikelihoods) if reduce is
+              set.
         """
-        pool = Pool(numThreads)
-        likelihoods = pool.map(unwrap_ddm_get_trial_likelihood,
-                               zip([self] * len(ddmTrials),
-                                   ddmTrials,
-                                   [timeStep] * len(ddmTrials),
-                                   [stateStep] * len(ddmTrials)))
-        pool.close()
-        return likelihoods
+        return util.parallel_get_likelihoods(
+            self, ddmTrials, timeStep=timeStep, stateStep=stateStep,
+            numThreads=numThreads, pool=pool, propagation=propagation,
+            tailTolerance=tailTolerance, deduplicate=deduplicate,
+            reduce=reduce, schedule=schedule, shardBounds=shardBounds)
 
 
-    def simulate_trial(self, QVLeft, QVRight, EVLeft, EVRight, probFractalDraw, timeStep=10):
+    def simulate_trial(self, QVLeft, QVRight, EVLeft, EVRight, probFractalDraw, timeStep=10,
+                       rng=None):
         """
         Generates a DDM trial given the item values.
         Args:
@@ -279,9 +499,16 @@ class DDM(object):
           valueRight: value of the right item.
           timeStep: integer, value in milliseconds to be used for binning the
               time axis.
+          rng: numpy.random.Generator used for the draws, e.g. from
+              util.get_condition_rngs. Defaults to the global numpy random
+              state, so that np.random.seed makes the trial reproducible. Pass
+              a generator in forked worker processes, which would otherwise
+              share that state.
         Returns:
           A DDMTrial object resulting from the simulation.
         """
+        if rng is None:
+            rng = np.random
         RDV = self.bias
         time = 0
         elapsedNDT = 0
@@ -290,15 +517,8 @@ class DDM(object):
 #         valueLeft = probFractalDraw*QVLeft + (1-probFractalDraw)*(EVLeft)
 #         valueRight = probFractalDraw*QVRight + (1-probFractalDraw)*(EVRight)
         
-        if probFractalDraw != 0 and probFractalDraw != 1:
-            distortedProbFractalDraw = np.exp((-1)*self.delta*((-1)*np.log(probFractalDraw))**self.gamma)
-        else:
-            distortedProbFractalDraw = probFractalDraw
-        
-        distortedProbFractalDraw = np.exp((-1)*self.delta*((-1)*np.log(probFractalDraw))**self.gamma)
-        leftFractalAdv =  distortedProbFractalDraw * (QVLeft - QVRight)
-        leftLotteryAdv = (1-probFractalDraw) * (EVLeft - EVRight)
-        weighted_mu = self.d * (leftFractalAdv + leftLotteryAdv)
+        weighted_mu = self.get_weighted_mu(QVLeft, QVRight, EVLeft, EVRight,
+                                           probFractalDraw)
     
         while True:
             # If the RDV hit one of the barriers, the trial is over.
@@ -317,13 +537,67 @@ class DDM(object):
                 mean = weighted_mu
 
             # Sample the change in RDV from the distribution.
-            RDV += np.random.normal(mean, self.sigma)
+            RDV += rng.normal(mean, self.sigma)
 
             time += 1
 
         return DDMTrial(RT, choice, QVRight, QVLeft, EVRight, EVLeft, probFractalDraw)
 
-        
+
+    def simulate_trials(self, conditions, numSimulations, timeStep=10,
+                        seed=None, chunkSize=100, commonRandomNumbers=False,
+                        firstCondition=0):
+        """
+        Generates many DDM trials at once for a set of trial conditions. All
+        trials are advanced together with array-wide normal draws (see
+        util.simulate_trials_batch) instead of one draw per trial and time
+        step.
+        Args:
+          conditions: list of trial conditions, where each trial condition is
+              a tuple with format (QVLeft, QVRight, EVLeft, EVRight,
+              probFractalDraw), a util.ConditionTable object, or a
+              util.TrialTable object, in which case its unique trial
+              conditions (see TrialTable.group_by_condition) are simulated.
+          numSimulations: integer, number of trials to simulate per condition.
+          timeStep: integer, value in milliseconds to be used for binning the
+              time axis.
+          seed: integer or numpy.random.SeedSequence, master seed for
+              reproducibility. The noise of each condition is drawn from its
+              own child stream, keyed by the index of the condition (see
+              util.get_condition_rngs), so the result does not depend on how
+              the conditions are split between calls or processes. If not
+              given, the master seed is drawn from the global numpy random
+              state, so that np.random.seed makes the result reproducible.
+          chunkSize: positive integer, number of time steps drawn at once.
+          commonRandomNumbers: boolean, whether to draw the noise of each
+              condition for all of its simulations at every chunk. Models
+              simulated with the same seed, conditions and chunkSize then
+              share their standardized noise (see
+              util.simulate_trials_batch).
+          firstCondition: integer, index of the first of the given conditions
+              in the full set, when simulating a shard of the conditions.
+        Returns:
+          A tuple (RTs, choices) of numpy arrays with shape (number of
+              conditions, numSimulations), holding the response time in
+              milliseconds and the choice (-1 for left, +1 for right) of each
+              simulated trial.
+        """
+        means = self.get_condition_means(
+            util.ConditionTable.from_conditions(conditions))
+        if commonRandomNumbers and seed is None:
+            raise ValueError(u"Error: a seed is needed to share random "
+                             "numbers across models.")
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        conditionRngs = util.get_condition_rngs(
+            seed, np.size(means), firstCondition=firstCondition)
+        return util.simulate_trials_batch(
+            means, numSimulations, self.sigma, self.barrier, bias=self.bias,
+            numNDTSteps=self.nonDecisionTime // timeStep, timeStep=timeStep,
+            chunkSize=chunkSize, conditionRngs=conditionRngs,
+            commonRandomNumbers=commonRandomNumbers)
+
+
 def wrap_ddm_get_model_log_likelihood(args):
     """
     Wrapper for DDM.get_model_log_likelihood(), intended for parallel
@@ -351,108 +625,75 @@ def unwrap_ddm_get_trial_likelihood(arg, **kwarg):
     return DDM.get_trial_likelihood(*arg, **kwarg)
         
     
-# Only does grid search for d and sigma; would need to add delta and gamma as well
+# Only does grid search for d and sigma; recover_pars_adaptive also searches
+# delta and gamma
     
 def recover_pars_pta(d, sigma, rangeD, rangeSigma, trialsFileName=None,
-         trialsPerCondition=800, numThreads=9, verbose=False):
+                     trialsPerCondition=800, numThreads=9, verbose=False,
+                     returnTrajectory=False, seed=None, storeFileName=None):
     """
-    Args:
-      d: float, DDM parameter for generating artificial data.
-      sigma: float, DDM parameter for generating artificial data.
-      rangeD: list of floats, search range for parameter d.
-      rangeSigma: list of floats, search range for parameter sigma.
-      trialsFileName: string, path of trial conditions file.
-      trialsPerCondition: int, number of artificial data trials to be
-          generated per trial condition.
-      numThreads: int, size of the thread pool.
-      verbose: boolean, whether or not to increase output verbosity.
+    Grid search recovery of d and sigma with this model. See
+    fitting.recover_pars_pta.
     """
-    # Load trial conditions.
-    if not trialsFileName:
-        trialsFileName = ("helpers/ddmSims/test_data/test_trial_conditions.csv")
-    trialConditions = load_trial_conditions_from_csv(trialsFileName)
+    return fitting.recover_pars_pta(
+        DDM, d, sigma, rangeD, rangeSigma, trialsFileName=trialsFileName,
+        trialsPerCondition=trialsPerCondition, numThreads=numThreads,
+        verbose=verbose, returnTrajectory=returnTrajectory, seed=seed,
+        storeFileName=storeFileName)
 
-    # Generate artificial data.
-    model = DDM(d, sigma)
-    trials = list()
-    for (QVLeft, QVRight, EVLeft, EVRight, probFractalDraw) in trialConditions:
-        for t in range(trialsPerCondition):
-            try:
-                trials.append(model.simulate_trial(QVLeft, QVRight, EVLeft, EVRight, probFractalDraw))
-            except:
-                print(u"An exception occurred while generating artificial "
-                      "trial " + str(t) + u" for condition (" +
-                      str(QVLeft) + u", " + str(QVRight) + u").")
-                raise
-
-    # Get likelihoods for all models and all artificial trials.
-    numModels = len(rangeD) * len(rangeSigma)
-    likelihoods = dict()
-    models = list()
-    posteriors = dict()
-    for d in rangeD:
-        for sigma in rangeSigma:
-            model = DDM(d, sigma)
-            if verbose:
-                print(u"Computing likelihoods for model " + str(model.params) +
-                      u"...")
-            try:
-                likelihoods[model.params] = model.parallel_get_likelihoods(
-                    trials, numThreads=numThreads)
-            except:
-                print(u"An exception occurred during the likelihood "
-                      "computations for model " + str(model.params) + u".")
-                raise
-            models.append(model)
-            posteriors[model.params] = 1 / numModels
-
-    # Compute the posteriors.
-    for t in range(len(trials)):
-        # Get the denominator for normalizing the posteriors.
-        denominator = 0
-        for model in models:
-            denominator += (posteriors[model.params] *
-                            likelihoods[model.params][t])
-        if denominator == 0:
-            continue
-
-        # Calculate the posteriors after this trial.
-        for model in models:
-            prior = posteriors[model.params]
-            posteriors[model.params] = (likelihoods[model.params][t] *
-                prior / denominator)
 
-    if verbose:
-        for model in models:
-            print(u"P" + str(model.params) +  u" = " +
-                  str(posteriors[model.params]))
-        print(u"Sum: " + str(sum(list(posteriors.values()))))
-        
-    return trials, models, likelihoods, posteriors
-
-
-def recover_pars_mla(d, sigma, rangeD, rangeSigma, trialsFileName=None, numTrials=10,
-         numSimulations=10, binStep=100, maxRT=8000, numThreads=9,
-         verbose=False):
+def recover_pars_mla(d, sigma, rangeD, rangeSigma, trialsFileName=None,
+                     numTrials=10, numSimulations=10, binStep=100, maxRT=8000,
+                     numThreads=9, verbose=False, commonRandomNumbers=False,
+                     seed=None, storeFileName=None):
     """
+    Simulation-based grid search recovery of d and sigma with this model. See
+    fitting.recover_pars_mla.
+    """
+    return fitting.recover_pars_mla(
+        DDM, d, sigma, rangeD, rangeSigma, trialsFileName=trialsFileName,
+        numTrials=numTrials, numSimulations=numSimulations, binStep=binStep,
+        maxRT=maxRT, numThreads=numThreads, verbose=verbose,
+        commonRandomNumbers=commonRandomNumbers, seed=seed,
+        storeFileName=storeFileName)
+
+
+def recover_pars_adaptive(d, sigma, delta, gamma, parRanges=None, trialsFileName=None,
+                          trialsPerCondition=800, numPoints=5, topK=3,
+                          resolution=None, numThreads=9, verbose=False,
+                          seed=None):
+    """
+    Recovers the model parameters from artificial data with a coarse-to-fine
+    grid search (see fitting.adaptive_grid_search), which only refines the
+    grid around the points with the highest likelihood instead of evaluating
+    a dense grid.
     Args:
       d: float, DDM parameter for generating artificial data.
       sigma: float, DDM parameter for generating artificial data.
-      rangeD: list of floats, search range for parameter d.
-      rangeSigma: list of floats, search range for parameter sigma.
+      delta: float, DDM parameter for generating artificial data.
+      gamma: float, DDM parameter for generating artificial data.
+      parRanges: dict with a (lower, upper) search range for each
+          searched parameter. Defaults to fitting.defaultBounds for d, sigma, delta
+          and gamma.
       trialsFileName: string, path of trial conditions file.
-      numTrials: int, number of artificial data trials to be generated per
-          trial condition.
-      numSimulations: int, number of simulations to be generated per trial
-          condition, to be used in the RT histograms.
-      binStep: int, size of the bin step to be used in the RT histograms.
-      maxRT: int, maximum RT to be used in the RT histograms.
+      trialsPerCondition: int, number of artificial data trials to be
+          generated per trial condition.
+      numPoints: int, number of values per parameter in the coarse grid.
+      topK: int, number of points refined at each level.
+      resolution: dict with the target spacing of each parameter.
       numThreads: int, size of the thread pool.
       verbose: boolean, whether or not to increase output verbosity.
+      seed: seed for simulating the artificial data. Defaults to a seed drawn
+          from the global numpy random state (see DDM.simulate_trials).
+    Returns:
+      A tuple (trials, search), where trials is the util.TrialTable with the
+          artificial data and search is the output of
+          fitting.adaptive_grid_search, including the number of likelihood
+          evaluations spent.
     """
-    pool = Pool(numThreads)
-
-    histBins = list(range(0, maxRT + binStep, binStep))
+    if parRanges is None:
+        parRanges = dict((name, fitting.defaultBounds[name])
+                         for name in (u"d", u"sigma", u"delta", u"gamma"))
 
     # Load trial conditions.
     if not trialsFileName:
@@ -460,58 +701,35 @@ def recover_pars_mla(d, sigma, rangeD, rangeSigma, trialsFileName=None, numTrial
     trialConditions = load_trial_conditions_from_csv(trialsFileName)
 
     # Generate artificial data.
-    dataRTLeft = dict()
-    dataRTRight = dict()
-    for trialCondition in trialConditions:
-        dataRTLeft[trialCondition] = list()
-        dataRTRight[trialCondition] = list()
-    model = DDM(d, sigma)
-    for trialCondition in trialConditions:
-        t = 0
-        while t < numTrials:
-            try:
-                trial = model.simulate_trial(
-                    trialCondition[0], trialCondition[1], trialCondition[2], trialCondition[3], trialCondition[4])
-            except:
-                print(u"An exception occurred while generating artificial "
-                      "trial " + str(t) + u" for condition " +
-                      str(trialCondition[0]) + u", " + str(trialCondition[1]) +
-                      u".")
-                raise
-            if trial.choice == -1:
-                dataRTLeft[trialCondition].append(trial.RT)
-            elif trial.choice == 1:
-                dataRTRight[trialCondition].append(trial.RT)
-            t += 1
-
-    # Generate histograms for artificial data.
-    dataHistLeft = dict()
-    dataHistRight = dict()
-    for trialCondition in trialConditions:
-        dataHistLeft[trialCondition] = np.histogram(
-            dataRTLeft[trialCondition], bins=histBins)[0]
-        dataHistRight[trialCondition] = np.histogram(
-            dataRTRight[trialCondition], bins=histBins)[0]
-
-    # Grid search on the parameters of the model.
+    model = DDM(d, sigma, delta, gamma)
+    try:
+        RTs, choices = model.simulate_trials(trialConditions,
+                                             trialsPerCondition, seed=seed)
+    except:
+        print(u"An exception occurred while generating artificial trials.")
+        raise
+    trials = util.TrialTable.from_simulation(trialConditions, RTs, choices)
+
+    search = fitting.adaptive_grid_search(
+        DDM, trials, parRanges, numPoints=numPoints, topK=topK,
+        resolution=resolution, numThreads=numThreads, verbose=verbose)
     if verbose:
-        print(u"Performing grid search over the model parameters...")
-    listParams = list()
-    models = list()
-    for d in rangeD:
-        for sigma in rangeSigma:
-            model = DDM(d, sigma)
-            models.append(model)
-            listParams.append((model, trialConditions, numSimulations,
-                              histBins, dataHistLeft, dataHistRight))
-    logLikelihoods = pool.map(wrap_ddm_get_model_log_likelihood, listParams)
-    pool.close()
+        print(u"Best fit: " + str(search[u"par"]) + u" after " +
+              str(search[u"numEvaluations"]) + u" likelihood evaluations.")
+    return trials, search
 
-    if verbose:
-        for i, model in enumerate(models):
-            print(u"L" + str(model.params) + u" = " + str(logLikelihoods[i]))
-        bestIndex = logLikelihoods.index(max(logLikelihoods))
-        print(u"Best fit: " + str(models[bestIndex].params))
 
-    return dataRTLeft, dataRTRight, dataHistLeft, dataHistRight, models, logLikelihoods
+def recover_pars_racing(d, sigma, rangeD, rangeSigma, trialsFileName=None,
+                        trialsPerCondition=800, initialTrials=100,
+                        pruneMargin=10, keepFraction=None, numThreads=9,
+                        seed=None, verbose=False):
+    """
+    Racing grid search recovery of d and sigma with this model. See
+    fitting.recover_pars_racing.
+    """
+    return fitting.recover_pars_racing(
+        DDM, d, sigma, rangeD, rangeSigma, trialsFileName=trialsFileName,
+        trialsPerCondition=trialsPerCondition, initialTrials=initialTrials,
+        pruneMargin=pruneMargin, keepFraction=keepFraction,
+        numThreads=numThreads, seed=seed, verbose=verbose)
 
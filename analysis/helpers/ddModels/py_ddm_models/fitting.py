@@ -0,0 +1,931 @@
+"""
+Fits the parameters of the Python DDM models by minimizing the negative
+log-likelihood of a data set with bounded continuous optimizers, as an
+alternative to the exhaustive grid searches of recover_pars_pta and
+recover_pars_mla. Like cluster_scripts/ddm_Roptim.R, any subset of the model
+parameters can be fitted while the others are held fixed, and every
+evaluation of the objective is recorded. Several optimizations are started
+from random points within the bounds and run in parallel, e.g.
+
+  from helpers.ddModels.py_ddm_models import ddm_model1a, fitting
+  fit = fitting.fit_ddm(ddm_model1a.DDM, trials,
+                        parNames=["d", "sigma", "delta", "gamma"])
+
+adaptive_grid_search is a grid-based alternative that refines a coarse grid
+only around its best points, and race_models prunes a fixed set of candidate
+models on growing subsets of the trials.
+
+The parameter recovery drivers recover_pars_pta, recover_pars_mla and
+recover_pars_racing are shared by the model modules, which call them with
+their own DDM class.
+"""
+import numpy as np
+from scipy.optimize import minimize
+from scipy.special import logsumexp
+
+from helpers.ddModels.py_ddm_models import util
+
+
+# Search bounds used for parameters without user-given bounds.
+defaultBounds = {
+    u"d": (1e-4, 0.1),
+    u"sigma": (0.01, 0.2),
+    u"delta": (0.05, 5),
+    u"gamma": (0.05, 5),
+    u"bias": (-0.9, 0.9),
+}
+
+# The state grid cannot resolve a transition kernel much narrower than its
+# state step: the kernel underflows between states and the likelihoods turn
+# into NaN. Searches whose sigma can go below stateStep / sigmaStepRatio are
+# rejected.
+sigmaStepRatio = 10
+
+# Added to the likelihoods before taking logs, as in get_task_nll in
+# fit_task.R, so that a single impossible trial does not make the objective
+# infinite.
+likelihoodFloor = 1e-200
+
+# Trial conditions used by the parameter recovery drivers when no file is
+# given.
+defaultTrialsFileName = u"helpers/ddmSims/test_data/test_trial_conditions.csv"
+
+
+class NegativeLogLikelihood(object):
+    """
+    Negative log-likelihood of a data set as a function of a vector of DDM
+    parameters, with the remaining parameters held fixed. Evaluations are
+    cached by parameter vector, so that points revisited by the optimizer
+    (or by different restarts run in the same process) are only computed
+    once, and every evaluation is recorded in order.
+    """
+    def __init__(self, modelClass, parNames, fixPars=None, timeStep=10,
+                 stateStep=0.1, propagation=u"dense", cacheDecimals=12):
+        """
+        Args:
+          modelClass: DDM class of the model to be fitted, e.g.
+              ddm_model1a.DDM.
+          parNames: list of strings, names of the DDM arguments that are
+              fitted, in the order of the parameter vectors.
+          fixPars: dict with the values of other DDM arguments, e.g.
+              {"nonDecisionTime": 300}.
+          timeStep: integer, value in milliseconds to be used for binning the
+              time axis.
+          stateStep: float, to be used for binning the RDV axis.
+          propagation: string, backend used to propagate the state
+              probabilities, one of util.propagationMethods.
+          cacheDecimals: int, number of decimals the parameter values are
+              rounded to when used as cache keys.
+        """
+        self.modelClass = modelClass
+        self.parNames = list(parNames)
+        self.fixPars = dict(fixPars) if fixPars else dict()
+        self.timeStep = timeStep
+        self.stateStep = stateStep
+        self.propagation = propagation
+        self.cacheDecimals = cacheDecimals
+        self.cache = dict()
+        self.iterations = list()
+        self.numCacheHits = 0
+
+    def get_model(self, parVals):
+        """
+        Args:
+          parVals: sequence of floats, values of the fitted parameters.
+        Returns:
+          The DDM object for the given parameter values.
+        """
+        pars = dict(self.fixPars)
+        pars.update(zip(self.parNames, (float(val) for val in parVals)))
+        return self.modelClass(**pars)
+
+    def __call__(self, parVals, trials, counts=None):
+        """
+        Args:
+          parVals: sequence of floats, values of the fitted parameters.
+          trials: util.TrialTable object or list of DDMTrial objects.
+          counts: numpy array with the number of times each trial occurs in
+              the data set, as returned by util.TrialTable.deduplicate. Each
+              trial counts once if not given.
+        Returns:
+          The negative log-likelihood of the trials.
+        """
+        key = tuple(np.round(np.asarray(parVals, dtype=float),
+                             self.cacheDecimals))
+        if key in self.cache:
+            self.numCacheHits += 1
+            return self.cache[key]
+        likelihoods = self.get_model(parVals).get_trials_likelihood_batch(
+            trials, timeStep=self.timeStep, approxStateStep=self.stateStep,
+            propagation=self.propagation)
+        logLikelihoods = np.log(likelihoods + likelihoodFloor)
+        if counts is not None:
+            logLikelihoods = counts * logLikelihoods
+        nll = -np.sum(logLikelihoods)
+        self.cache[key] = nll
+        self.iterations.append(key + (nll,))
+        return nll
+
+    def optimize(self, trials, startVals, bounds, method=u"L-BFGS-B",
+                 maxIter=500, counts=None):
+        """
+        Minimizes the negative log-likelihood from one starting point.
+        Args:
+          trials: util.TrialTable object or list of DDMTrial objects.
+          startVals: sequence of floats, starting values of the fitted
+              parameters.
+          bounds: list of (lower, upper) pairs, one per fitted parameter.
+          method: string, bounded method of scipy.optimize.minimize, e.g.
+              "L-BFGS-B", "Nelder-Mead" or "Powell".
+          maxIter: int, maximum number of iterations of the optimizer.
+          counts: numpy array with the multiplicity of each trial, see
+              __call__.
+        Returns:
+          A dict with the starting values ("startVals"), the fitted values
+              ("par"), the negative log-likelihood at the fitted values
+              ("nll"), the optimizer status ("success", "message"), the
+              number of likelihood computations and cache hits
+              ("numEvaluations", "numCacheHits") and the evaluations of this
+              run ("iterations"), as rows of parameter values followed by the
+              negative log-likelihood.
+        """
+        firstIteration = len(self.iterations)
+        firstCacheHit = self.numCacheHits
+        result = minimize(self, np.asarray(startVals, dtype=float),
+                          args=(trials, counts), method=method, bounds=bounds,
+                          options={u"maxiter": maxIter})
+        iterations = self.iterations[firstIteration:]
+        return {
+            u"startVals": [float(val) for val in startVals],
+            u"par": dict(zip(self.parNames,
+                             (float(val) for val in result.x))),
+            u"nll": float(result.fun),
+            u"success": bool(result.success),
+            u"message": str(result.message),
+            u"numEvaluations": len(iterations),
+            u"numCacheHits": self.numCacheHits - firstCacheHit,
+            u"iterations": iterations,
+        }
+
+
+class OptimizationRun(object):
+    """
+    One optimization of a NegativeLogLikelihood from a given starting point,
+    which can be sent to the workers of a util.ModelPool.
+    """
+    def __init__(self, objective, startVals):
+        """
+        Args:
+          objective: NegativeLogLikelihood object.
+          startVals: sequence of floats, starting values of the fitted
+              parameters.
+        """
+        self.objective = objective
+        self.startVals = startVals
+
+    def run(self, trials, counts, bounds, method=u"L-BFGS-B", maxIter=500):
+        """
+        Args:
+          trials, counts, bounds, method, maxIter: see
+              NegativeLogLikelihood.optimize.
+        Returns:
+          The output of NegativeLogLikelihood.optimize.
+        """
+        return self.objective.optimize(trials, self.startVals, bounds,
+                                       method=method, maxIter=maxIter,
+                                       counts=counts)
+
+
+def check_sigma_bounds(lower, stateStep):
+    """
+    Checks that the state grid can resolve the smallest searched sigma.
+    Args:
+      lower: float, lower bound of the search range of sigma.
+      stateStep: float, approximate size of the bins of the RDV axis.
+    """
+    if lower * sigmaStepRatio < stateStep:
+        raise ValueError(u"Error: the lower bound of sigma (" + str(lower) +
+                         u") must be at least the state step (" +
+                         str(stateStep) + u") divided by " +
+                         str(sigmaStepRatio) + u".")
+
+
+def get_start_values(bounds, numRestarts, startVals=None, seed=None):
+    """
+    Draws the starting points of the restarts uniformly within the bounds.
+    Args:
+      bounds: list of (lower, upper) pairs, one per fitted parameter.
+      numRestarts: int, total number of starting points.
+      startVals: list of user-given starting points, used first. All of them
+          are kept even if there are more than numRestarts.
+      seed: seed for the random number generator.
+    Returns:
+      A numRestarts x P numpy array of starting points.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    given = (np.asarray(startVals, dtype=float).reshape(-1, len(bounds))
+             if startVals is not None else np.zeros((0, len(bounds))))
+    numRandom = max(numRestarts - given.shape[0], 0)
+    rng = np.random.default_rng(seed)
+    randomVals = rng.uniform(bounds[:, 0], bounds[:, 1],
+                             size=(numRandom, len(bounds)))
+    return np.concatenate([given, randomVals])
+
+
+def get_optimization_runs(modelClass, trials, parNames, bounds=None,
+                          fixPars=None, numRestarts=8, startVals=None,
+                          seed=None, timeStep=10, stateStep=0.1,
+                          propagation=u"dense"):
+    """
+    Sets up the optimizations of fit_ddm for one data set.
+    Args:
+      modelClass, trials, parNames, bounds, fixPars, numRestarts, startVals,
+          seed, timeStep, stateStep, propagation: see fit_ddm.
+    Returns:
+      A tuple (uniqueTrials, counts, parBounds, runs), with the unique trials
+          and their multiplicities (see util.TrialTable.deduplicate), the list
+          of (lower, upper) bounds of the fitted parameters and a list of
+          OptimizationRun objects, one per starting point.
+    """
+    parNames = list(parNames)
+    bounds = dict(bounds) if bounds else dict()
+    try:
+        parBounds = [tuple(bounds.get(name, defaultBounds[name]))
+                     for name in parNames]
+    except KeyError as e:
+        print(u"No bounds given for parameter " + str(e) + u".")
+        raise
+    if u"sigma" in parNames:
+        check_sigma_bounds(parBounds[parNames.index(u"sigma")][0], stateStep)
+    # Trials with the same condition, choice and time step are only
+    # evaluated once, and weighted by their multiplicity.
+    trials, _, counts = util.TrialTable.from_trials(trials).deduplicate(
+        timeStep=timeStep)
+    objective = NegativeLogLikelihood(
+        modelClass, parNames, fixPars=fixPars, timeStep=timeStep,
+        stateStep=stateStep, propagation=propagation)
+    allStartVals = get_start_values(parBounds, numRestarts,
+                                    startVals=startVals, seed=seed)
+    runs = [OptimizationRun(objective, vals) for vals in allStartVals]
+    return trials, counts, parBounds, runs
+
+
+def summarize_restarts(restarts):
+    """
+    Combines the optimizations of a fit from different starting points.
+    Args:
+      restarts: list with the output of NegativeLogLikelihood.optimize for
+          each starting point. Sorted by nll in place.
+    Returns:
+      A dict with the best fitted values ("par"), their negative
+          log-likelihood ("nll"), the output of each optimization
+          ("restarts", sorted by nll) and the total number of likelihood
+          computations and cache hits ("numEvaluations", "numCacheHits").
+    """
+    restarts.sort(key=lambda restart: restart[u"nll"])
+    return {
+        u"par": restarts[0][u"par"],
+        u"nll": restarts[0][u"nll"],
+        u"restarts": restarts,
+        u"numEvaluations": sum(restart[u"numEvaluations"]
+                               for restart in restarts),
+        u"numCacheHits": sum(restart[u"numCacheHits"]
+                             for restart in restarts),
+    }
+
+
+def fit_ddm(modelClass, trials, parNames=(u"d", u"sigma"), bounds=None,
+            fixPars=None, numRestarts=8, startVals=None, method=u"L-BFGS-B",
+            maxIter=500, numThreads=4, seed=None, timeStep=10,
+            stateStep=0.1, propagation=u"dense", verbose=False):
+    """
+    Fits the parameters of a DDM to a data set by minimizing the negative
+    log-likelihood from several starting points. With more than one thread,
+    the restarts run in parallel on a util.ModelPool holding the trials;
+    otherwise they run in this process and share a single evaluation cache.
+    Args:
+      modelClass: DDM class of the model to be fitted, e.g. ddm_model1a.DDM.
+      trials: util.TrialTable object or list of DDMTrial objects.
+      parNames: list of strings, names of the DDM arguments to be fitted.
+      bounds: dict with a (lower, upper) pair for each fitted parameter.
+          Parameters not in the dict use defaultBounds.
+      fixPars: dict with the values of other DDM arguments.
+      numRestarts: int, number of optimizations from different starting
+          points.
+      startVals: list of starting points, used before the random ones.
+      method: string, bounded method of scipy.optimize.minimize.
+      maxIter: int, maximum number of iterations of each optimization.
+      numThreads: int, size of the process pool.
+      seed: seed for the random starting points.
+      timeStep, stateStep, propagation: see NegativeLogLikelihood.
+      verbose: boolean, whether or not to increase output verbosity.
+    Returns:
+      A dict with the best fitted values ("par"), their negative
+          log-likelihood ("nll"), the output of each optimization
+          ("restarts", sorted by nll) and the total number of likelihood
+          computations and cache hits ("numEvaluations", "numCacheHits").
+    """
+    trials, counts, parBounds, runs = get_optimization_runs(
+        modelClass, trials, parNames, bounds=bounds, fixPars=fixPars,
+        numRestarts=numRestarts, startVals=startVals, seed=seed,
+        timeStep=timeStep, stateStep=stateStep, propagation=propagation)
+    if verbose:
+        print(u"Running " + str(len(runs)) + u" optimizations of " +
+              u", ".join(parNames) + u"...")
+    try:
+        if numThreads > 1:
+            with util.ModelPool(numThreads, trials=trials,
+                                counts=counts) as pool:
+                restarts = pool.map(runs, u"run", [u"trials", u"counts"],
+                                    bounds=parBounds, method=method,
+                                    maxIter=maxIter)
+        else:
+            restarts = [run.run(trials, counts, parBounds, method=method,
+                                maxIter=maxIter) for run in runs]
+    except:
+        print(u"An exception occurred during the optimization of " +
+              u", ".join(parNames) + u".")
+        raise
+
+    fit = summarize_restarts(restarts)
+    if verbose:
+        for restart in restarts:
+            print(u"Start " + str(restart[u"startVals"]) + u": " +
+                  str(restart[u"par"]) + u", NLL = " + str(restart[u"nll"]))
+    return fit
+
+
+def adaptive_grid_search(modelClass, trials, parRanges, numPoints=5, topK=3,
+                         resolution=None, fixPars=None, numThreads=4,
+                         timeStep=10, stateStep=0.1, propagation=u"dense",
+                         verbose=False):
+    """
+    Searches the parameters of a DDM on a grid that is refined only around
+    the best points. A coarse grid of numPoints values per parameter is
+    evaluated first. Then, at each level, the spacing is halved and the cell
+    around each of the topK points with the highest log-likelihood is
+    subdivided, i.e. the points at -1/2, 0 and +1/2 of the old spacing from
+    it are evaluated in every dimension. This stops once the spacing of every
+    parameter is at most its target resolution. With a uniform prior over the
+    points, ranking them by posterior is the same as ranking them by
+    log-likelihood. Points shared by several cells are evaluated once.
+    Args:
+      modelClass: DDM class of the model, e.g. ddm_model1a.DDM.
+      trials: util.TrialTable object or list of DDMTrial objects.
+      parRanges: dict with a (lower, upper) pair for each searched DDM
+          argument, e.g. {"d": (0.01, 0.1), "sigma": (0.01, 0.1)}.
+      numPoints: int, number of values per parameter in the coarse grid.
+      topK: int, number of points refined at each level.
+      resolution: dict with the target spacing of each parameter. Defaults
+          to an eighth of the coarse spacing, i.e. three refinement levels.
+      fixPars: dict with the values of other DDM arguments.
+      numThreads: int, size of the process pool.
+      timeStep, stateStep, propagation: see NegativeLogLikelihood.
+      verbose: boolean, whether or not to increase output verbosity.
+    Returns:
+      A dict with the best point ("par") and its log-likelihood
+          ("logLikelihood"), all evaluated points ("points", a list of
+          (parameter dict, log-likelihood) pairs, in evaluation order), the
+          posteriors of the points of the last level under a uniform prior
+          ("posteriors", in the same format), the number of evaluations
+          at each level ("levelEvaluations") and in total ("numEvaluations").
+    """
+    parNames = list(parRanges)
+    if u"sigma" in parRanges:
+        check_sigma_bounds(parRanges[u"sigma"][0], stateStep)
+    lower = np.array([parRanges[name][0] for name in parNames], dtype=float)
+    upper = np.array([parRanges[name][1] for name in parNames], dtype=float)
+    spacing = (upper - lower) / (numPoints - 1)
+    if resolution is None:
+        targetSpacing = spacing / 8
+    else:
+        targetSpacing = np.array([resolution[name] for name in parNames],
+                                 dtype=float)
+    trials, _, counts = util.TrialTable.from_trials(trials).deduplicate(
+        timeStep=timeStep)
+    objective = NegativeLogLikelihood(
+        modelClass, parNames, fixPars=fixPars, timeStep=timeStep,
+        stateStep=stateStep, propagation=propagation)
+
+    logLikelihoods = dict()
+    levelEvaluations = list()
+
+    def evaluate(points, pool):
+        # Only points that have not been evaluated yet are computed.
+        keys = [tuple(float(val) for val in
+                      np.round(point, objective.cacheDecimals))
+                for point in points]
+        newKeys = list(dict.fromkeys(key for key in keys
+                                     if key not in logLikelihoods))
+        models = [objective.get_model(key) for key in newKeys]
+        try:
+            if pool is not None:
+                likelihoods = pool.map(
+                    models, u"get_trials_likelihood_batch", [u"trials"],
+                    timeStep=timeStep, approxStateStep=stateStep,
+                    propagation=propagation)
+            else:
+                likelihoods = [model.get_trials_likelihood_batch(
+                    trials, timeStep=timeStep, approxStateStep=stateStep,
+                    propagation=propagation) for model in models]
+        except:
+            print(u"An exception occurred during the likelihood "
+                  "computations of the adaptive grid.")
+            raise
+        for key, likelihood in zip(newKeys, likelihoods):
+            logLikelihoods[key] = np.sum(counts *
+                                         np.log(likelihood + likelihoodFloor))
+        levelEvaluations.append(len(newKeys))
+        if verbose:
+            print(u"Level " + str(len(levelEvaluations) - 1) + u": " +
+                  str(len(newKeys)) + u" new points.")
+        return list(dict.fromkeys(keys))
+
+    def search(pool):
+        axes = [np.linspace(low, high, numPoints)
+                for low, high in zip(lower, upper)]
+        points = evaluate(np.stack(np.meshgrid(*axes, indexing=u"ij"),
+                                   axis=-1).reshape(-1, len(parNames)), pool)
+        step = spacing
+        offsets = np.stack(np.meshgrid(*[[-0.5, 0, 0.5]] * len(parNames),
+                                       indexing=u"ij"),
+                           axis=-1).reshape(-1, len(parNames))
+        while np.any(step > targetSpacing * (1 + 1e-9)):
+            best = sorted(points, key=lambda key: logLikelihoods[key],
+                          reverse=True)[:topK]
+            newPoints = (np.array(best)[:, np.newaxis, :] +
+                         offsets * step).reshape(-1, len(parNames))
+            points = evaluate(np.clip(newPoints, lower, upper), pool)
+            step = step / 2
+        return points
+
+    if numThreads > 1:
+        with util.ModelPool(numThreads, trials=trials) as pool:
+            lastPoints = search(pool)
+    else:
+        lastPoints = search(None)
+
+    lastLogLikelihoods = np.array([logLikelihoods[key] for key in lastPoints])
+    posteriors = np.exp(lastLogLikelihoods - logsumexp(lastLogLikelihoods))
+    bestKey = max(logLikelihoods, key=logLikelihoods.get)
+    return {
+        u"par": dict(zip(parNames, bestKey)),
+        u"logLikelihood": float(logLikelihoods[bestKey]),
+        u"points": [(dict(zip(parNames, key)), float(logLikelihood))
+                    for key, logLikelihood in logLikelihoods.items()],
+        u"posteriors": [(dict(zip(parNames, key)), float(posterior))
+                        for key, posterior in zip(lastPoints, posteriors)],
+        u"levelEvaluations": levelEvaluations,
+        u"numEvaluations": len(logLikelihoods),
+    }
+
+
+def race_models(models, trials, initialTrials=100, pruneMargin=10,
+                keepFraction=None, numThreads=4, seed=None, timeStep=10,
+                stateStep=0.1, propagation=u"dense", verbose=False):
+    """
+    Compares candidate models on growing random subsets of the trials,
+    discarding the ones that are hopelessly behind before paying for the
+    full data set. All candidates are first scored on initialTrials trials.
+    After each round, the candidates whose log-likelihood is more than
+    pruneMargin below the best one are discarded (optionally keeping at most
+    a keepFraction of the candidates, as in successive halving), and the
+    subset is doubled for the survivors, until it covers all trials. Since
+    the subsets are nested, each round only computes the likelihoods of the
+    trials added to the subset.
+    Args:
+      models: list of DDM objects, the candidates.
+      trials: util.TrialTable object or list of DDMTrial objects.
+      initialTrials: int, size of the first subset.
+      pruneMargin: float, log-likelihood gap to the best candidate beyond
+          which a candidate is discarded. A gap of 10 means that the data so
+          far is e^10 times more likely under the best candidate.
+      keepFraction: float, largest fraction of the candidates kept after each
+          round, or None to prune on pruneMargin alone.
+      numThreads: int, size of the process pool.
+      seed: seed for the random order of the trials.
+      timeStep, stateStep, propagation: see NegativeLogLikelihood.
+      verbose: boolean, whether or not to increase output verbosity.
+    Returns:
+      A dict with the surviving models ("survivors"), their log-likelihoods
+          on all trials ("logLikelihoods"), their posteriors under a uniform
+          prior over the survivors ("posteriors"), the history of the rounds
+          ("rounds", one dict per round with the subset size "numTrials",
+          the scored models "models", their log-likelihoods
+          "logLikelihoods", the pruning threshold "threshold" and the indices
+          of the survivors in models "survivorIndices") and the number of
+          trial likelihoods computed ("numTrialEvaluations").
+    """
+    if initialTrials < 1:
+        raise ValueError(u"Error: initialTrials must be at least 1.")
+    if pruneMargin < 0:
+        raise ValueError(u"Error: pruneMargin must be non-negative.")
+    trials = util.TrialTable.from_trials(trials)
+    rng = np.random.default_rng(seed)
+    trials = trials[rng.permutation(len(trials))]
+    numTrials = len(trials)
+
+    def score(candidates, shard, pool):
+        kwargs = dict(timeStep=timeStep, approxStateStep=stateStep,
+                      propagation=propagation)
+        try:
+            if pool is not None:
+                likelihoods = pool.map(candidates,
+                                       u"get_trials_likelihood_batch",
+                                       [u"trials"], shard=shard, **kwargs)
+            else:
+                likelihoods = [model.get_trials_likelihood_batch(
+                    trials[shard[0]:shard[1]], **kwargs)
+                    for model in candidates]
+        except:
+            print(u"An exception occurred during the likelihood "
+                  "computations of the race.")
+            raise
+        return np.array([np.sum(np.log(likelihood + likelihoodFloor))
+                         for likelihood in likelihoods])
+
+    def race(pool):
+        candidates = list(models)
+        logLikelihoods = np.zeros(len(candidates))
+        rounds = list()
+        numTrialEvaluations = 0
+        start = 0
+        stop = min(initialTrials, numTrials)
+        while True:
+            logLikelihoods = logLikelihoods + score(candidates, (start, stop),
+                                                    pool)
+            numTrialEvaluations += len(candidates) * (stop - start)
+            if stop >= numTrials:
+                # All trials have been scored; nothing is pruned any more.
+                threshold = -np.inf
+            else:
+                threshold = np.max(logLikelihoods) - pruneMargin
+                if keepFraction is not None:
+                    numKept = int(np.ceil(keepFraction * len(candidates)))
+                    threshold = max(threshold, np.sort(logLikelihoods)[::-1]
+                                    [numKept - 1])
+            survivorIndices = np.flatnonzero(logLikelihoods >= threshold)
+            rounds.append({
+                u"numTrials": stop,
+                u"models": candidates,
+                u"logLikelihoods": logLikelihoods,
+                u"threshold": float(threshold),
+                u"survivorIndices": survivorIndices,
+            })
+            if verbose:
+                print(u"Scored " + str(len(candidates)) + u" models on " +
+                      str(stop) + u" trials; " + str(survivorIndices.size) +
+                      u" survive.")
+            candidates = [candidates[i] for i in survivorIndices]
+            logLikelihoods = logLikelihoods[survivorIndices]
+            if stop >= numTrials:
+                break
+            start, stop = stop, min(2 * stop, numTrials)
+
+        return {
+            u"survivors": candidates,
+            u"logLikelihoods": logLikelihoods,
+            u"posteriors": np.exp(logLikelihoods -
+                                  logsumexp(logLikelihoods)),
+            u"rounds": rounds,
+            u"numTrialEvaluations": numTrialEvaluations,
+        }
+
+    if numThreads > 1:
+        with util.ModelPool(numThreads, trials=trials) as pool:
+            return race(pool)
+    return race(None)
+
+
+def recover_pars_pta(modelClass, d, sigma, rangeD, rangeSigma,
+                     trialsFileName=None, trialsPerCondition=800,
+                     numThreads=9, verbose=False, returnTrajectory=False,
+                     seed=None, storeFileName=None):
+    """
+    Args:
+      modelClass: DDM class of the model, e.g. ddm_model1.DDM. Both the
+          artificial data and the models of the grid are built from it.
+      d: float, DDM parameter for generating artificial data.
+      sigma: float, DDM parameter for generating artificial data.
+      rangeD: list of floats, search range for parameter d.
+      rangeSigma: list of floats, search range for parameter sigma.
+      trialsFileName: string, path of trial conditions file.
+      trialsPerCondition: int, number of artificial data trials to be
+          generated per trial condition.
+      numThreads: int, size of the thread pool.
+      verbose: boolean, whether or not to increase output verbosity.
+      returnTrajectory: boolean, whether to also return the posteriors after
+          every trial, as a models x trials numpy array in the order of the
+          returned models.
+      seed: seed for simulating the artificial data.
+      storeFileName: string, path of a util.ResultStore file. The likelihoods
+          of each model are added to it as soon as they are computed, and
+          models already in it for the same data are not computed again, so
+          that a stopped run can be resumed. Requires a seed, so that the
+          resumed run simulates the same data.
+    """
+    # Load trial conditions.
+    if not trialsFileName:
+        trialsFileName = defaultTrialsFileName
+    trialConditions = util.load_trial_conditions_from_csv(trialsFileName)
+
+    # Generate artificial data. The trials are held in a columnar
+    # util.TrialTable, ordered by trial condition.
+    model = modelClass(d, sigma)
+    try:
+        RTs, choices = model.simulate_trials(trialConditions,
+                                             trialsPerCondition, seed=seed)
+    except:
+        print(u"An exception occurred while generating artificial trials.")
+        raise
+    trials = util.TrialTable.from_simulation(trialConditions, RTs, choices)
+
+    # Get likelihoods for all models and all artificial trials. The same pool
+    # of processes is used for all models. It only holds the unique
+    # (condition, time step, choice) trials, whose likelihoods are expanded
+    # back to all trials, ordered so that each worker gets a shard of whole
+    # trial conditions with balanced cost.
+    numModels = len(rangeD) * len(rangeSigma)
+    likelihoods = dict()
+    models = list()
+    posteriors = dict()
+    uniqueTrials, trialIndex, _ = trials.deduplicate()
+    order, shardBounds, _ = util.schedule_trials(
+        uniqueTrials, numThreads,
+        numStates=util.get_state_grid(model.barrier, 0.1)[0].size)
+    store = None
+    if storeFileName:
+        if seed is None:
+            raise ValueError(u"Error: a seed is required to store the "
+                             "likelihoods.")
+        store = util.ResultStore(storeFileName, util.get_dataset_key(
+            [getattr(uniqueTrials, name) for name in util.TrialTable.columns],
+            dict(model=modelClass.__module__.split(u".")[-1], timeStep=10,
+                 stateStep=0.1)))
+    try:
+        # Likelihoods of the unique trials of each model, in the order of
+        # uniqueTrials. Models already in the store are loaded first, so that
+        # the pool is only started if some are missing.
+        uniqueLikelihoods = dict()
+        for d in rangeD:
+            for sigma in rangeSigma:
+                model = modelClass(d, sigma)
+                models.append(model)
+                posteriors[model.params] = 1 / numModels
+                if store is not None:
+                    stored = store.get(model.params)
+                    if stored is not None:
+                        if verbose:
+                            print(u"Loaded likelihoods for model " +
+                                  str(model.params) + u".")
+                        uniqueLikelihoods[model.params] = stored
+        pending = [model for model in models
+                   if model.params not in uniqueLikelihoods]
+        if pending:
+            with util.ModelPool(numThreads,
+                                trials=uniqueTrials[order]) as pool:
+                for model in pending:
+                    if verbose:
+                        print(u"Computing likelihoods for model " +
+                              str(model.params) + u"...")
+                    try:
+                        computed = np.empty(len(uniqueTrials))
+                        computed[order] = model.parallel_get_likelihoods(
+                            uniqueTrials[order], pool=pool,
+                            shardBounds=shardBounds)
+                    except:
+                        print(u"An exception occurred during the "
+                              "likelihood computations for model " +
+                              str(model.params) + u".")
+                        raise
+                    if store is not None:
+                        store.put(model.params, computed)
+                    uniqueLikelihoods[model.params] = computed
+        for model in models:
+            likelihoods[model.params] = (
+                uniqueLikelihoods[model.params][trialIndex])
+    finally:
+        if store is not None:
+            store.close()
+
+    # Compute the posteriors, updating them trial by trial in log space.
+    posteriorArray = util.get_posteriors(
+        np.array([likelihoods[model.params] for model in models]),
+        priors=np.array([posteriors[model.params] for model in models]),
+        returnTrajectory=returnTrajectory)
+    if returnTrajectory:
+        posteriorArray, trajectory = posteriorArray
+    for i, model in enumerate(models):
+        posteriors[model.params] = posteriorArray[i]
+
+    if verbose:
+        for model in models:
+            print(u"P" + str(model.params) +  u" = " +
+                  str(posteriors[model.params]))
+        print(u"Sum: " + str(sum(list(posteriors.values()))))
+        
+    if returnTrajectory:
+        return trials, models, likelihoods, posteriors, trajectory
+    return trials, models, likelihoods, posteriors
+
+
+def recover_pars_mla(modelClass, d, sigma, rangeD, rangeSigma,
+                     trialsFileName=None, numTrials=10, numSimulations=10,
+                     binStep=100, maxRT=8000, numThreads=9, verbose=False,
+                     commonRandomNumbers=False, seed=None,
+                     storeFileName=None):
+    """
+    Args:
+      modelClass: DDM class of the model, e.g. ddm_model1.DDM. Both the
+          artificial data and the models of the grid are built from it.
+      d: float, DDM parameter for generating artificial data.
+      sigma: float, DDM parameter for generating artificial data.
+      rangeD: list of floats, search range for parameter d.
+      rangeSigma: list of floats, search range for parameter sigma.
+      trialsFileName: string, path of trial conditions file.
+      numTrials: int, number of artificial data trials to be generated per
+          trial condition.
+      numSimulations: int, number of simulations to be generated per trial
+          condition, to be used in the RT histograms.
+      binStep: int, size of the bin step to be used in the RT histograms.
+      maxRT: int, maximum RT to be used in the RT histograms.
+      numThreads: int, size of the thread pool.
+      verbose: boolean, whether or not to increase output verbosity.
+      commonRandomNumbers: boolean, whether all models of the grid simulate
+          their RT histograms from the same standardized noise, which makes
+          the comparison between neighbouring models much less noisy for a
+          given numSimulations.
+      seed: integer, master seed of all the simulations. The artificial data
+          is simulated from its child stream 0 and model i of the grid from
+          child stream (1, i), or all models from child stream 1 when
+          commonRandomNumbers is set, so results do not depend on numThreads.
+          Drawn at random if not given.
+      storeFileName: string, path of a util.ResultStore file. The
+          log-likelihood of each model is added to it as soon as it is
+          computed, and models already in it for the same data, seed and
+          settings are not computed again, so that a stopped run can be
+          resumed with the same seed.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        if verbose:
+            print(u"Using seed " + str(seed) + u".")
+    histBins = list(range(0, maxRT + binStep, binStep))
+
+    # Load trial conditions.
+    if not trialsFileName:
+        trialsFileName = defaultTrialsFileName
+    trialConditions = util.load_trial_conditions_from_csv(trialsFileName)
+
+    # Generate artificial data.
+    model = modelClass(d, sigma)
+    try:
+        RTs, choices = model.simulate_trials(
+            trialConditions, numTrials, seed=util.get_seed_sequence(seed, 0))
+    except:
+        print(u"An exception occurred while generating artificial trials.")
+        raise
+    dataRTLeft = dict()
+    dataRTRight = dict()
+    for i, trialCondition in enumerate(trialConditions):
+        dataRTLeft[trialCondition] = list(RTs[i][choices[i] == -1])
+        dataRTRight[trialCondition] = list(RTs[i][choices[i] == 1])
+
+    # Generate histograms for artificial data. The conditions x bins x choices
+    # array is built once and used for all models.
+    dataHists = util.get_rt_histograms(
+        np.repeat(np.arange(len(trialConditions)), numTrials), RTs, choices,
+        len(trialConditions), histBins)
+    dataHistLeft = dict()
+    dataHistRight = dict()
+    for i, trialCondition in enumerate(trialConditions):
+        dataHistLeft[trialCondition] = dataHists[i, :, 0]
+        dataHistRight[trialCondition] = dataHists[i, :, 1]
+
+    # Grid search on the parameters of the model.
+    if verbose:
+        print(u"Performing grid search over the model parameters...")
+    models = list()
+    for d in rangeD:
+        for sigma in rangeSigma:
+            models.append(modelClass(d, sigma))
+    if commonRandomNumbers:
+        taskKwargs = [dict(seed=util.get_seed_sequence(seed, 1),
+                           commonRandomNumbers=True)] * len(models)
+    else:
+        taskKwargs = [dict(seed=util.get_seed_sequence(seed, 1, i))
+                      for i in range(len(models))]
+    # Models are keyed in the store by their parameters and by the child
+    # stream of their simulations, which is shared by all models with
+    # commonRandomNumbers and depends on the position in the grid otherwise.
+    logLikelihoods = [None] * len(models)
+    store = None
+    storeKeys = [model.params + tuple(kwargs[u"seed"].spawn_key)
+                 for model, kwargs in zip(models, taskKwargs)]
+    if storeFileName:
+        store = util.ResultStore(storeFileName, util.get_dataset_key(
+            [np.array(trialConditions), dataHists],
+            dict(model=modelClass.__module__.split(u".")[-1], seed=seed,
+                 numSimulations=numSimulations, histBins=histBins)))
+        for i, storeKey in enumerate(storeKeys):
+            logLikelihood = store.get(storeKey)
+            if logLikelihood is not None:
+                logLikelihoods[i] = float(logLikelihood)
+        if verbose:
+            print(u"Loaded " + str(len(models) - logLikelihoods.count(None)) +
+                  u" of " + str(len(models)) + u" models from the store.")
+    pending = [i for i in range(len(models)) if logLikelihoods[i] is None]
+    # The data histograms and the compiled trial conditions are sent once to
+    # each process of the pool, so that the tasks only carry the models and
+    # each worker reuses the drifts cached for the parameters it has seen.
+    # Each log-likelihood is stored as soon as its task completes.
+    try:
+        if pending:
+            with util.ModelPool(numThreads,
+                                trialConditions=util.ConditionTable(
+                                    trialConditions),
+                                numSimulations=numSimulations,
+                                histBins=histBins,
+                                dataHists=dataHists) as pool:
+                tasks = [(models[i], u"get_model_log_likelihood",
+                          [u"trialConditions", u"numSimulations",
+                           u"histBins", u"dataHists"], taskKwargs[i])
+                         for i in pending]
+                for taskIndex, logLikelihood in pool.imap_unordered(tasks):
+                    i = pending[taskIndex]
+                    logLikelihoods[i] = logLikelihood
+                    if store is not None:
+                        store.put(storeKeys[i], logLikelihood)
+    finally:
+        if store is not None:
+            store.close()
+
+    if verbose:
+        for i, model in enumerate(models):
+            print(u"L" + str(model.params) + u" = " + str(logLikelihoods[i]))
+        bestIndex = logLikelihoods.index(max(logLikelihoods))
+        print(u"Best fit: " + str(models[bestIndex].params))
+
+    return (dataRTLeft, dataRTRight, dataHistLeft, dataHistRight, models,
+            logLikelihoods)
+
+
+def recover_pars_racing(modelClass, d, sigma, rangeD, rangeSigma,
+                        trialsFileName=None, trialsPerCondition=800,
+                        initialTrials=100, pruneMargin=10, keepFraction=None,
+                        numThreads=9, seed=None, verbose=False):
+    """
+    Racing version of recover_pars_pta: the models of the grid are scored on
+    growing random subsets of the artificial trials, and the ones that fall
+    hopelessly behind are discarded early (see fitting.race_models).
+    Args:
+      modelClass: DDM class of the model, e.g. ddm_model1.DDM. Both the
+          artificial data and the models of the grid are built from it.
+      d: float, DDM parameter for generating artificial data.
+      sigma: float, DDM parameter for generating artificial data.
+      rangeD: list of floats, search range for parameter d.
+      rangeSigma: list of floats, search range for parameter sigma.
+      trialsFileName: string, path of trial conditions file.
+      trialsPerCondition: int, number of artificial data trials to be
+          generated per trial condition.
+      initialTrials: int, number of trials in the first subset.
+      pruneMargin: float, log-likelihood gap to the best model beyond which a
+          model is discarded.
+      keepFraction: float, largest fraction of the models kept after each
+          round, or None to prune on pruneMargin alone.
+      numThreads: int, size of the thread pool.
+      seed: integer, master seed of the artificial data and of the order in
+          which the trials enter the race. If None, the data is drawn from the
+          global numpy random state and the order is random.
+      verbose: boolean, whether or not to increase output verbosity.
+    Returns:
+      A tuple (trials, race), where trials is the util.TrialTable with the
+          artificial data and race is the output of fitting.race_models,
+          including the pruning thresholds and the survivors of each round.
+    """
+    # Load trial conditions.
+    if not trialsFileName:
+        trialsFileName = defaultTrialsFileName
+    trialConditions = util.load_trial_conditions_from_csv(trialsFileName)
+
+    # Generate artificial data.
+    model = modelClass(d, sigma)
+    try:
+        RTs, choices = model.simulate_trials(
+            trialConditions, trialsPerCondition,
+            seed=None if seed is None else util.get_seed_sequence(seed, 0))
+    except:
+        print(u"An exception occurred while generating artificial trials.")
+        raise
+    trials = util.TrialTable.from_simulation(trialConditions, RTs, choices)
+
+    models = [modelClass(d, sigma) for d in rangeD for sigma in rangeSigma]
+    race = race_models(
+        models, trials, initialTrials=initialTrials, pruneMargin=pruneMargin,
+        keepFraction=keepFraction, numThreads=numThreads,
+        seed=None if seed is None else util.get_seed_sequence(seed, 1),
+        verbose=verbose)
+    if verbose:
+        for model, posterior in zip(race[u"survivors"], race[u"posteriors"]):
+            print(u"P" + str(model.params) + u" = " + str(posterior))
+    return trials, race
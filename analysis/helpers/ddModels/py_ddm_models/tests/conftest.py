@@ -0,0 +1,57 @@
+"""
+Shared fixtures for the tests of the Python DDM models, e.g. run from the
+analysis directory with
+
+  python -m pytest helpers/ddModels/py_ddm_models/tests
+
+The models are imported as helpers.ddModels.py_ddm_models, like in the
+analysis scripts, so the analysis directory is put on the path.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                *[os.pardir] * 4)))
+
+from helpers.ddModels.py_ddm_models import ddm_model1, ddm_model1a, util
+
+
+# A few trial conditions, with fields as in util.conditionFields.
+testConditions = [
+    (0.512, 0.95, -0.712, 0.897, 0),
+    (0.55, 0.028, 0.507, 0.076, 0.2),
+    (0.134, 0.403, -0.593, -0.475, 0.5),
+    (0.161, 0.97, 0.032, -0.768, 1),
+]
+
+
+@pytest.fixture(params=[(ddm_model1, (0.05, 0.08)),
+                        (ddm_model1a, (0.05, 0.08, 1.2, 0.8))],
+                ids=[u"ddm_model1", u"ddm_model1a"])
+def model(request):
+    module, params = request.param
+    return module.DDM(*params)
+
+
+@pytest.fixture
+def trialConditions():
+    return list(testConditions)
+
+
+@pytest.fixture
+def trials(model, trialConditions):
+    RTs, choices = model.simulate_trials(trialConditions, 20, seed=1)
+    return util.TrialTable.from_simulation(trialConditions, RTs, choices)
+
+
+@pytest.fixture
+def trialsFileName(tmp_path):
+    fileName = tmp_path / u"trial_conditions.csv"
+    with open(fileName, u"wt") as csvFile:
+        csvFile.write(u",".join(util.conditionFields) + u"\n")
+        for condition in testConditions:
+            csvFile.write(u",".join(str(value) for value in condition) +
+                          u"\n")
+    return str(fileName)
@@ -0,0 +1,19 @@
+"""
+The analytic first-passage time likelihoods against the discretized engine.
+"""
+import numpy as np
+
+
+def test_analytic_matches_fine_batch(model, trials):
+    # The discretized engine only approximates the analytic densities, up to
+    # the discretization of the time and RDV axes.
+    analytic = model.get_trials_likelihood_analytic(trials)
+    batch = model.get_trials_likelihood_batch(trials, approxStateStep=0.01)
+    np.testing.assert_allclose(analytic, batch, atol=0.02)
+
+
+def test_analytic_falls_back_to_batch(model, trials):
+    model.nonDecisionTime = 300
+    np.testing.assert_array_equal(
+        model.get_trials_likelihood_analytic(trials),
+        model.get_trials_likelihood_batch(trials))
@@ -0,0 +1,36 @@
+"""
+The batch likelihood engine against the per-trial likelihoods.
+"""
+import numpy as np
+
+
+def test_batch_matches_per_trial(model, trials):
+    perTrial = np.array([model.get_trial_likelihood(trials[i])
+                         for i in range(len(trials))])
+    batch = model.get_trials_likelihood_batch(trials)
+    np.testing.assert_allclose(batch, perTrial, rtol=1e-9, atol=1e-15)
+
+
+def test_batch_matches_per_trial_with_non_decision_time(model, trials):
+    model.nonDecisionTime = 300
+    perTrial = np.array([model.get_trial_likelihood(trials[i])
+                         for i in range(len(trials))])
+    batch = model.get_trials_likelihood_batch(trials)
+    np.testing.assert_allclose(batch, perTrial, rtol=1e-9, atol=1e-15)
+
+
+def test_condition_crossings_give_every_rt(model, trials):
+    # A single forward pass per condition, up to the longest RT of the table,
+    # yields the likelihood of each trial at its own RT.
+    conditions, conditionIndex = trials.group_by_condition()
+    probUpCrossing, probDownCrossing = (
+        model.get_condition_crossing_probabilities(conditions,
+                                                   np.max(trials.RT)))
+    numTimeSteps = trials.RT // 10
+    expected = np.where(
+        trials.choice == -1,
+        probUpCrossing[conditionIndex, numTimeSteps - 1],
+        probDownCrossing[conditionIndex, numTimeSteps - 1])
+    perTrial = np.array([model.get_trial_likelihood(trials[i])
+                         for i in range(len(trials))])
+    np.testing.assert_allclose(expected, perTrial, rtol=1e-9, atol=1e-15)
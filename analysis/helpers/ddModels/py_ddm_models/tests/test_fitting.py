@@ -0,0 +1,29 @@
+"""
+Tests of the search setup in fitting.
+"""
+import pytest
+
+from helpers.ddModels.py_ddm_models import fitting
+
+
+def test_default_sigma_bounds_accepted(model, trials):
+    _, _, parBounds, runs = fitting.get_optimization_runs(
+        type(model), trials, (u"d", u"sigma"), numRestarts=2, seed=1)
+    assert parBounds[1] == fitting.defaultBounds[u"sigma"]
+    assert len(runs) == 2
+
+
+def test_unresolvable_sigma_bounds_rejected(model, trials):
+    with pytest.raises(ValueError):
+        fitting.get_optimization_runs(
+            type(model), trials, (u"d", u"sigma"),
+            bounds={u"sigma": (1e-3, 0.2)}, numRestarts=2, seed=1)
+    with pytest.raises(ValueError):
+        fitting.adaptive_grid_search(
+            type(model), trials, {u"d": (1e-4, 0.1), u"sigma": (0.005, 0.2)},
+            stateStep=0.1)
+    # A finer state grid resolves narrower kernels.
+    fitting.get_optimization_runs(
+        type(model), trials, (u"d", u"sigma"),
+        bounds={u"sigma": (0.005, 0.2)}, numRestarts=2, seed=1,
+        stateStep=0.05)
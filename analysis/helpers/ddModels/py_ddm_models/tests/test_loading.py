@@ -0,0 +1,33 @@
+"""
+Loading of the trial conditions files and of their binary cache.
+"""
+import numpy as np
+import pytest
+
+from helpers.ddModels.py_ddm_models import util
+
+
+def test_cached_load_matches_csv(trialsFileName, trialConditions):
+    for _ in range(2):
+        conditions = util.load_trial_conditions(trialsFileName)
+        np.testing.assert_array_equal(conditions, trialConditions)
+
+
+@pytest.mark.parametrize(u"corruption", [u"truncated", u"garbage"])
+def test_corrupt_cache_is_rebuilt(trialsFileName, trialConditions,
+                                  corruption):
+    util.load_trial_conditions(trialsFileName)
+    cacheFileName = trialsFileName + u".npz"
+    with open(cacheFileName, u"rb") as cacheFile:
+        cacheBytes = cacheFile.read()
+    with open(cacheFileName, u"wb") as cacheFile:
+        if corruption == u"truncated":
+            cacheFile.write(cacheBytes[:len(cacheBytes) // 2])
+        else:
+            cacheFile.write(b"PK\x03\x04" + b"\x00" * 64)
+
+    conditions = util.load_trial_conditions(trialsFileName)
+    np.testing.assert_array_equal(conditions, trialConditions)
+    with np.load(cacheFileName) as cache:
+        np.testing.assert_array_equal(cache[u"column_QVLeft"],
+                                      conditions[:, 0])
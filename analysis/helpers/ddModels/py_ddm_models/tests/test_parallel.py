@@ -0,0 +1,54 @@
+"""
+Results computed in a pool of worker processes must not depend on the number
+of workers.
+"""
+import numpy as np
+
+from helpers.ddModels.py_ddm_models import ddm_model1, util
+
+
+def test_parallel_likelihoods_match_serial(model, trials):
+    serial = model.get_trials_likelihood_batch(trials)
+    for numThreads in (1, 3):
+        likelihoods = model.parallel_get_likelihoods(trials,
+                                                     numThreads=numThreads)
+        np.testing.assert_allclose(likelihoods, serial, rtol=1e-12,
+                                   atol=1e-15)
+
+
+def test_parallel_likelihoods_with_pool(model, trials):
+    serial = model.get_trials_likelihood_batch(trials)
+    with util.ModelPool(3, trials=trials) as pool:
+        likelihoods = model.parallel_get_likelihoods(trials, pool=pool)
+    np.testing.assert_allclose(likelihoods, serial, rtol=1e-12, atol=1e-15)
+
+
+def test_sharded_simulation_matches_full(model, trialConditions):
+    full = model.simulate_trials(trialConditions, 50, seed=7)
+    parts = [model.simulate_trials(trialConditions[i:i + 3], 50, seed=7,
+                                   firstCondition=i)
+             for i in range(0, len(trialConditions), 3)]
+    for i in range(2):
+        np.testing.assert_array_equal(
+            full[i], np.concatenate([part[i] for part in parts]))
+
+
+def test_simulation_follows_global_seed(model, trialConditions):
+    simulations = list()
+    for _ in range(2):
+        np.random.seed(3)
+        trial = model.simulate_trial(*trialConditions[0])
+        RTs, choices = model.simulate_trials(trialConditions, 20)
+        simulations.append((trial.RT, trial.choice, RTs, choices))
+    for first, second in zip(*simulations):
+        np.testing.assert_array_equal(first, second)
+
+
+def test_recover_pars_mla_reproducible_across_workers(trialsFileName):
+    logLikelihoods = [
+        ddm_model1.recover_pars_mla(
+            0.05, 0.08, [0.04, 0.05], [0.07, 0.08],
+            trialsFileName=trialsFileName, numTrials=20, numSimulations=30,
+            numThreads=numThreads, seed=11)[-1]
+        for numThreads in (1, 3)]
+    assert logLikelihoods[0] == logLikelihoods[1]
@@ -0,0 +1,47 @@
+"""
+util.get_posteriors against the trial-by-trial Bayesian update it replaces.
+"""
+import numpy as np
+import pytest
+
+from helpers.ddModels.py_ddm_models import util
+
+
+def update_posteriors(likelihoods, priors):
+    """
+    Trial-by-trial update of the posteriors, skipping the trials with zero
+    likelihood under every model with positive posterior probability.
+    """
+    posteriors = np.array(priors, dtype=float)
+    trajectory = np.zeros(likelihoods.shape)
+    for t in range(likelihoods.shape[1]):
+        denominator = np.sum(posteriors * likelihoods[:, t])
+        if denominator != 0:
+            posteriors = likelihoods[:, t] * posteriors / denominator
+        trajectory[:, t] = posteriors
+    return posteriors, trajectory
+
+
+@pytest.mark.parametrize(u"seed", range(20))
+def test_get_posteriors_matches_update(seed):
+    rng = np.random.default_rng(seed)
+    numModels, numTrials = rng.integers(1, 5), rng.integers(0, 30)
+    # Zero out some likelihoods so that some trials are skipped.
+    likelihoods = rng.random((numModels, numTrials)) * (
+        rng.random((numModels, numTrials)) > 0.5)
+    priors = rng.random(numModels) + 0.1
+    priors /= priors.sum()
+
+    posteriors, trajectory = util.get_posteriors(likelihoods, priors=priors,
+                                                 returnTrajectory=True)
+    expected, expectedTrajectory = update_posteriors(likelihoods, priors)
+    np.testing.assert_allclose(posteriors, expected, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(trajectory, expectedTrajectory, rtol=1e-9,
+                               atol=1e-12)
+
+
+def test_get_posteriors_does_not_underflow():
+    likelihoods = np.full((2, 5000), 1e-3)
+    likelihoods[0] *= 2
+    posteriors = util.get_posteriors(likelihoods)
+    np.testing.assert_allclose(posteriors, [1, 0], atol=1e-12)
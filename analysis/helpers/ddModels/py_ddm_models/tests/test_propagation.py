@@ -0,0 +1,39 @@
+"""
+Agreement between the propagation backends of the likelihood engines.
+"""
+import numpy as np
+import pytest
+
+from helpers.ddModels.py_ddm_models import util
+
+
+@pytest.mark.parametrize(u"propagation", util.propagationMethods)
+def test_propagation_backends_agree(model, trials, propagation):
+    util.defaultKernelCache.clear()
+    dense = model.get_trials_likelihood_batch(trials, propagation=u"dense")
+    likelihoods = model.get_trials_likelihood_batch(trials,
+                                                    propagation=propagation)
+    np.testing.assert_allclose(likelihoods, dense, rtol=1e-9, atol=1e-12)
+    perTrial = np.array([model.get_trial_likelihood(
+        trials[i], propagation=propagation) for i in range(len(trials))])
+    np.testing.assert_allclose(perTrial, dense, rtol=1e-9, atol=1e-12)
+
+
+def test_auto_picks_direct_for_narrow_grids():
+    assert util.resolve_propagation(u"auto", 21) == u"direct"
+    assert (util.resolve_propagation(u"auto", util.autoFFTNumStates) ==
+            u"fft")
+
+
+@pytest.mark.parametrize(u"numRows", [0, 3])
+def test_direct_kernel_is_truncated(numRows):
+    states, stateStep = util.get_state_grid(1, 0.01)
+    kernel = util.TransitionKernel(0.02, 0.05, stateStep, 1, states)
+    firstOffset, weights = kernel.directWeights
+    assert weights.size < states.size
+    # A single state vector, or several stacked ones.
+    shape = (numRows, states.size) if numRows else (states.size,)
+    prStates = np.random.default_rng(0).random(shape)
+    np.testing.assert_allclose(kernel.propagate(prStates, u"direct"),
+                               kernel.propagate(prStates, u"dense"),
+                               rtol=1e-12, atol=1e-15)
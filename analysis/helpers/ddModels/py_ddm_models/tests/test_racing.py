@@ -0,0 +1,36 @@
+"""
+Tests of fitting.race_models and the racing recovery.
+"""
+import numpy as np
+import pytest
+
+from helpers.ddModels.py_ddm_models import fitting
+
+
+def test_invalid_race_settings_rejected(model, trials):
+    with pytest.raises(ValueError):
+        fitting.race_models([model], trials, initialTrials=0, numThreads=1)
+    with pytest.raises(ValueError):
+        fitting.race_models([model], trials, pruneMargin=-1, numThreads=1)
+
+
+def test_race_keeps_best_model(model, trials):
+    models = [type(model)(*model.params), type(model)(0.001, 0.2)]
+    race = fitting.race_models(models, trials, initialTrials=10,
+                               numThreads=1, seed=1)
+    assert race[u"survivors"][0].params == model.params
+    assert race[u"rounds"][0][u"numTrials"] == 10
+
+
+def test_seeded_racing_recovery_reproducible(model, trialsFileName):
+    def recover():
+        return fitting.recover_pars_racing(
+            type(model), 0.05, 0.08, [0.03, 0.05], [0.08],
+            trialsFileName=trialsFileName, trialsPerCondition=20,
+            initialTrials=10, numThreads=1, seed=3)
+    trials, race = recover()
+    otherTrials, otherRace = recover()
+    np.testing.assert_array_equal(trials.RT, otherTrials.RT)
+    np.testing.assert_array_equal(trials.choice, otherTrials.choice)
+    np.testing.assert_array_equal(race[u"logLikelihoods"],
+                                  otherRace[u"logLikelihoods"])
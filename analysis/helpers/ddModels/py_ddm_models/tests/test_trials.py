@@ -0,0 +1,10 @@
+"""
+The columnar trial store and the views of its trials.
+"""
+
+
+def test_trial_views_match_columns(trials):
+    for i in range(len(trials)):
+        trial = trials[i]
+        for name in trials.columns + (u"valueLeft", u"valueRight"):
+            assert getattr(trial, name) == getattr(trials, name)[i]
@@ -1,31 +1,1971 @@
+from collections import OrderedDict
 import csv
+import hashlib
+import io
+from multiprocessing import Pool, SimpleQueue
+import numpy as np
+import os
+import scipy.fft
+from scipy.special import logsumexp
+from scipy.stats import norm
+import sqlite3
+import time
+import zipfile
 
-def load_trial_conditions_from_csv(trialsFileName):
+
+# Columns of a trial conditions file, in the order used for trial condition
+# tuples.
+conditionFields = (u"QVLeft", u"QVRight", u"EVLeft", u"EVRight",
+                   u"probFractalDraw")
+
+
+def load_columns_from_csv(fileName, fieldNames, useCache=True):
     """
-    Loads trial conditions from a CSV file. Format expected for trial
-    conditions file: value_left, value_right.
+    Loads numeric columns from a CSV file (e.g. the per-subject files written
+    by save_sub_data.R) straight into numpy arrays. The header is checked for
+    the required fields before any row is parsed. A binary copy of the
+    columns is cached next to the CSV file, as fileName + ".npz", and reused
+    as long as the modification time and size of the CSV file and the
+    requested fields are unchanged.
     Args:
-      trialsFileName: string, name of trial conditions file. 
+      fileName: string, name of the CSV file.
+      fieldNames: list of strings, names of the columns to load.
+      useCache: boolean, whether to read and write the binary cache.
+    Returns:
+      A dict indexed by field name, where each entry is a float numpy array
+          with the values of that column.
+    """
+    fieldNames = list(fieldNames)
+    fileStat = os.stat(fileName)
+    cacheFileName = fileName + u".npz"
+    cacheKey = np.array([fileStat.st_mtime_ns, fileStat.st_size])
+
+    if useCache and os.path.exists(cacheFileName):
+        try:
+            with np.load(cacheFileName) as cache:
+                if (np.array_equal(cache[u"cacheKey"], cacheKey) and
+                    list(cache[u"fieldNames"]) == fieldNames):
+                    return dict((name, cache[u"column_" + name])
+                                for name in fieldNames)
+        except (OSError, ValueError, KeyError, EOFError,
+                zipfile.BadZipFile):
+            # A corrupt or truncated cache is rebuilt from the CSV file.
+            pass
+
+    with open(fileName, u"rt", newline=u"") as csvFile:
+        header = next(csv.reader(csvFile), [])
+    missing = [name for name in fieldNames if name not in header]
+    if missing:
+        raise RuntimeError(u"Missing field in file " + fileName + u": " +
+                           u", ".join(missing) + u". Fields required: " +
+                           u", ".join(fieldNames) + u".")
+    try:
+        values = np.loadtxt(fileName, delimiter=u",", skiprows=1, ndmin=2,
+                            quotechar=u"\"",
+                            usecols=[header.index(name) for name in fieldNames])
+    except ValueError as e:
+        raise RuntimeError(u"Error while reading file " + fileName + u": " +
+                           str(e))
+    columns = dict((name, values[:, i]) for i, name in enumerate(fieldNames))
+
+    if useCache:
+        # Write to a temporary file first so that a concurrent reader never
+        # sees a partial cache.
+        tempFileName = cacheFileName + u"." + str(os.getpid()) + u".tmp"
+        try:
+            with open(tempFileName, u"wb") as tempFile:
+                np.savez(tempFile, cacheKey=cacheKey,
+                         fieldNames=np.array(fieldNames),
+                         **dict((u"column_" + name, column)
+                                for name, column in columns.items()))
+            os.replace(tempFileName, cacheFileName)
+        except OSError:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+    return columns
 
+
+def load_trial_conditions(trialsFileName, useCache=True):
+    """
+    Loads trial conditions from a CSV file into a numpy array. Fields required
+    in the trial conditions file: QVLeft, QVRight, EVLeft, EVRight,
+    probFractalDraw.
+    Args:
+      trialsFileName: string, name of trial conditions file.
+      useCache: boolean, whether to use the binary cache of the file (see
+          load_columns_from_csv).
+    Returns:
+      A N x 5 numpy array, where each row is a trial condition with format
+          (QVLeft, QVRight, EVLeft, EVRight, probFractalDraw).
+    """
+    columns = load_columns_from_csv(trialsFileName, conditionFields,
+                                    useCache=useCache)
+    return np.column_stack([columns[name] for name in conditionFields])
+
+
+def load_trial_conditions_from_csv(trialsFileName, useCache=True):
+    """
+    Loads trial conditions from a CSV file. Fields required in the trial
+    conditions file: QVLeft, QVRight, EVLeft, EVRight, probFractalDraw.
+    Args:
+      trialsFileName: string, name of trial conditions file.
+      useCache: boolean, whether to use the binary cache of the file (see
+          load_columns_from_csv).
     Returns:
       A list containing the trial conditions, where each trial condition is a
-          tuple with format (value_left, value_right).
+          tuple with format (QVLeft, QVRight, EVLeft, EVRight,
+          probFractalDraw).
     """
-    trialConditions = []
-    try:
-        with open(trialsFileName, u"rt") as csvfile:
-            reader = csv.DictReader(csvfile)
-            if (u"QVLeft" not in reader.fieldnames or
-                u"QVRight" not in reader.fieldnames or
-                u"EVRight" not in reader.fieldnames or
-                u"EVLeft" not in reader.fieldnames or
-                u"probFractalDraw" not in reader.fieldnames):
-                raise RuntimeError(u"Missing field in trial conditions file. "
-                                   "Fields required: QVLeft, QVRight, EVLeft, EVRight, probFractalDraw")
-            for row in reader:
-                trialConditions.append(
-                    (float(row[u"QVLeft"]), float(row[u"QVRight"]), float(row[u"EVLeft"]), float(row[u"EVRight"]), float(row[u"probFractalDraw"])))
-    except:
-        print(u"Error while reading trial conditions file " + trialsFileName)
-        raise
-    return trialConditions
\ No newline at end of file
+    return [tuple(condition) for condition in
+            load_trial_conditions(trialsFileName, useCache=useCache).tolist()]
+
+
+class TrialView(object):
+    """
+    Read-only view of one trial of a TrialTable, with the same attributes as
+    a DDMTrial object. It holds no data of its own.
+    """
+    __slots__ = (u"_table", u"_index")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        if name in TrialTable.columns:
+            return getattr(self._table, name)[self._index]
+        raise AttributeError(name)
+
+    # The combined item values are computed from the values of this trial
+    # only, rather than by indexing the derived columns of the whole table.
+    @property
+    def valueLeft(self):
+        return (self.probFractalDraw * self.QVLeft +
+                (1 - self.probFractalDraw) * self.EVLeft)
+
+    @property
+    def valueRight(self):
+        return (self.probFractalDraw * self.QVRight +
+                (1 - self.probFractalDraw) * self.EVRight)
+
+
+class TrialTable(object):
+    """
+    Columnar store of DDM trials, holding each trial attribute in a contiguous
+    numpy array instead of one DDMTrial object per trial. Slicing returns a
+    new TrialTable that shares memory with the original one, and indexing a
+    single trial returns a TrialView that can be used wherever a DDMTrial is
+    expected.
+    """
+    columns = (u"RT", u"choice", u"QVLeft", u"QVRight", u"EVLeft", u"EVRight",
+               u"probFractalDraw")
+    conditionColumns = (u"QVLeft", u"QVRight", u"EVLeft", u"EVRight",
+                        u"probFractalDraw")
+
+    def __init__(self, RT, choice, QVLeft, QVRight, EVLeft, EVRight,
+                 probFractalDraw):
+        """
+        Args:
+          RT: array of response times in milliseconds.
+          choice: array of choices, either -1 (for left item) or +1 (for right
+              item).
+          QVLeft: array of Q values of the left fractal.
+          QVRight: array of Q values of the right fractal.
+          EVLeft: array of expected values of the left lottery.
+          EVRight: array of expected values of the right lottery.
+          probFractalDraw: array of probabilities of the fractal being drawn.
+        """
+        self.RT = np.asarray(RT, dtype=int)
+        self.choice = np.asarray(choice, dtype=int)
+        self.QVLeft = np.asarray(QVLeft, dtype=float)
+        self.QVRight = np.asarray(QVRight, dtype=float)
+        self.EVLeft = np.asarray(EVLeft, dtype=float)
+        self.EVRight = np.asarray(EVRight, dtype=float)
+        self.probFractalDraw = np.asarray(probFractalDraw, dtype=float)
+        self._groups = None
+        self._compiled = None
+        for name in self.columns:
+            if getattr(self, name).shape != self.RT.shape:
+                raise ValueError(u"Error: all columns of a TrialTable must "
+                                 "have the same shape.")
+
+    @classmethod
+    def from_trials(cls, trials):
+        """
+        Builds a TrialTable from a list of DDMTrial objects. Trials that only
+        carry the combined item values (valueLeft, valueRight), such as the
+        ones created by ddm_model1.DDM.simulate_trial, are stored as fractal
+        values with probFractalDraw = 1, so that the linearly weighted values
+        are unchanged.
+        Args:
+          trials: list of DDMTrial objects.
+        Returns:
+          A TrialTable object.
+        """
+        if isinstance(trials, cls):
+            return trials
+        if len(trials) > 0 and not hasattr(trials[0], u"probFractalDraw"):
+            return cls([trial.RT for trial in trials],
+                       [trial.choice for trial in trials],
+                       [trial.valueLeft for trial in trials],
+                       [trial.valueRight for trial in trials],
+                       np.zeros(len(trials)), np.zeros(len(trials)),
+                       np.ones(len(trials)))
+        return cls(*[[getattr(trial, name) for trial in trials]
+                     for name in cls.columns])
+
+    @classmethod
+    def from_simulation(cls, conditions, RTs, choices):
+        """
+        Builds a TrialTable from the output of DDM.simulate_trials.
+        Args:
+          conditions: list of trial conditions, where each trial condition is
+              a tuple with format (QVLeft, QVRight, EVLeft, EVRight,
+              probFractalDraw).
+          RTs: numpy array with shape (number of conditions, number of
+              simulations), response times in milliseconds.
+          choices: numpy array with the same shape as RTs, choices.
+        Returns:
+          A TrialTable object, with the trials ordered by condition.
+        """
+        conditions = np.asarray(conditions, dtype=float).reshape(-1, 5)
+        RTs = np.asarray(RTs)
+        numSimulations = RTs.shape[1] if RTs.ndim > 1 else 1
+        conditionColumns = np.repeat(conditions, numSimulations, axis=0).T
+        return cls(RTs.ravel(), np.asarray(choices).ravel(),
+                   *conditionColumns)
+
+    def __len__(self):
+        return self.RT.size
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield TrialView(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError(u"TrialTable index out of range.")
+            return TrialView(self, key)
+        return TrialTable(*[getattr(self, name)[key]
+                            for name in self.columns])
+
+    @property
+    def valueLeft(self):
+        """
+        Value of the left item, weighting the fractal and lottery values
+        linearly by the probability of a fractal draw.
+        """
+        return (self.probFractalDraw * self.QVLeft +
+                (1 - self.probFractalDraw) * self.EVLeft)
+
+    @property
+    def valueRight(self):
+        """
+        Value of the right item, weighting the fractal and lottery values
+        linearly by the probability of a fractal draw.
+        """
+        return (self.probFractalDraw * self.QVRight +
+                (1 - self.probFractalDraw) * self.EVRight)
+
+    def get_conditions(self):
+        """
+        Returns:
+          A N x 5 numpy array with the trial condition (QVLeft, QVRight,
+              EVLeft, EVRight, probFractalDraw) of each trial.
+        """
+        return np.column_stack([getattr(self, name)
+                                for name in self.conditionColumns])
+
+    def group_by_condition(self):
+        """
+        Groups the trials by trial condition.
+        Returns:
+          A tuple (conditions, conditionIndex), where conditions is a K x 5
+              numpy array with the unique trial conditions and conditionIndex
+              is a numpy array of size N with the index of the condition of
+              each trial.
+        """
+        # The grouping is computed once and reused, since the likelihood
+        # engines group the same table for every model.
+        if self._groups is None:
+            conditions, conditionIndex = np.unique(
+                self.get_conditions(), axis=0, return_inverse=True)
+            self._groups = (conditions, conditionIndex.ravel())
+        return self._groups
+
+    def compile(self):
+        """
+        Compiles the unique trial conditions of the table for repeated model
+        evaluations. The ConditionTable is built once and reused, so the
+        arrays it caches for each parameter set are shared by all the models
+        evaluated on this table.
+        Returns:
+          A ConditionTable object with the conditions of group_by_condition,
+              in the same order, so that conditionIndex also indexes it.
+        """
+        if self._compiled is None:
+            self._compiled = ConditionTable(self.group_by_condition()[0])
+        return self._compiled
+
+    def deduplicate(self, timeStep=None):
+        """
+        Collapses trials that share their trial condition, choice and RT, and
+        therefore have the same likelihood under any model.
+        Args:
+          timeStep: integer, value in milliseconds used for binning the time
+              axis. If given, trials are compared on RT // timeStep instead of
+              RT, since the likelihood engines only look at the time step.
+        Returns:
+          A tuple (uniqueTrials, trialIndex, counts), where uniqueTrials is a
+              TrialTable with one trial per unique key, trialIndex is a numpy
+              array of size N with the index in uniqueTrials of each trial, so
+              that per-trial results are expanded by results[trialIndex], and
+              counts is a numpy array with the number of trials collapsed into
+              each unique trial.
+        """
+        RT = self.RT if timeStep is None else self.RT // timeStep
+        keys = np.column_stack([RT, self.choice, self.get_conditions()])
+        _, firstIndex, trialIndex, counts = np.unique(
+            keys, axis=0, return_index=True, return_inverse=True,
+            return_counts=True)
+        return self[firstIndex], trialIndex.ravel(), counts
+
+
+class ConditionTable(object):
+    """
+    Trial conditions of a data set compiled for evaluating many models on it.
+    The value differences of the conditions are computed once, the
+    probabilities of a fractal draw are mapped to their few distinct values,
+    and arrays that only depend on some model parameters, such as the
+    distorted probabilities of each (delta, gamma) or the drift of each
+    condition, are cached, so that they are computed once per parameter set
+    instead of once per trial.
+    """
+    def __init__(self, conditions, maxCacheSize=256):
+        """
+        Args:
+          conditions: C x 5 array or list of trial conditions, where each
+              trial condition has format (QVLeft, QVRight, EVLeft, EVRight,
+              probFractalDraw).
+          maxCacheSize: positive integer, maximum number of cached arrays
+              before the least recently used one is evicted.
+        """
+        if maxCacheSize < 1:
+            raise ValueError("Error: maxCacheSize parameter must be at least "
+                             "one.")
+        self.conditions = np.asarray(conditions, dtype=float).reshape(-1, 5)
+        QVLeft, QVRight, EVLeft, EVRight, probFractalDraw = self.conditions.T
+        self.fractalDiff = QVLeft - QVRight
+        self.lotteryDiff = EVLeft - EVRight
+        self.probFractalDraw = probFractalDraw
+        self.probValues, probIndex = np.unique(probFractalDraw,
+                                               return_inverse=True)
+        self.probIndex = probIndex.ravel()
+        self.maxCacheSize = maxCacheSize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return self.conditions.shape[0]
+
+    def __iter__(self):
+        for condition in self.conditions.tolist():
+            yield tuple(condition)
+
+    @classmethod
+    def from_conditions(cls, conditions):
+        """
+        Args:
+          conditions: ConditionTable object, util.TrialTable object (whose
+              unique conditions are used) or C x 5 array or list of trial
+              conditions.
+        Returns:
+          A ConditionTable object, which is conditions itself or the compiled
+              table of a TrialTable when possible.
+        """
+        if isinstance(conditions, cls):
+            return conditions
+        if isinstance(conditions, TrialTable):
+            return conditions.compile()
+        return cls(conditions)
+
+    def get_cached(self, key, compute):
+        """
+        Returns a cached array, computing it if it is not already in the
+        cache.
+        Args:
+          key: hashable key identifying the array, e.g. the name of the
+              quantity followed by the parameter values it depends on.
+          compute: function without arguments that computes the array.
+        Returns:
+          The cached array.
+        """
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        self._cache[key] = compute()
+        if len(self._cache) > self.maxCacheSize:
+            self._cache.popitem(last=False)
+        return self._cache[key]
+
+
+# Propagation backends for the state probabilities. "dense" multiplies by the
+# full S x S transition matrix, while "direct" and "fft" apply the Gaussian
+# increment kernel as a 1-D convolution over state offsets. "direct" only
+# convolves with the offsets whose weight is not negligible in double
+# precision, see TransitionKernel.directWeights, so its cost grows with the
+# kernel width rather than with S, while "fft" uses the full kernel. "banded"
+# convolves with the kernel truncated to the offsets whose tails hold more
+# than the tail tolerance, and falls back to "dense" when the band covers more
+# than bandedMaxFraction of the grid. "auto" picks "fft" for state grids of at
+# least autoFFTNumStates states and "direct" for narrower ones.
+propagationMethods = (u"dense", u"direct", u"fft", u"banded", u"auto")
+autoFFTNumStates = 256
+bandedMaxFraction = 0.5
+
+
+def resolve_propagation(propagation, numStates):
+    """
+    Resolves the "auto" propagation backend for a given state grid size.
+    Args:
+      propagation: string, one of propagationMethods.
+      numStates: integer, number of states in the grid.
+    Returns:
+      The name of the propagation backend to use.
+    """
+    if propagation not in propagationMethods:
+        raise ValueError(u"Error: propagation must be one of " +
+                         u", ".join(propagationMethods) + u".")
+    if propagation == u"auto":
+        return u"fft" if numStates >= autoFFTNumStates else u"direct"
+    return propagation
+
+
+class TransitionKernel(object):
+    """
+    Transition kernel of the RDV for one drift mean. Since the states are
+    equally spaced, the probability of changing from state j to state i only
+    depends on the offset i - j, so the S x S transition matrix is a Toeplitz
+    matrix built from a 1-D kernel of 2S - 1 offsets. The matrix and the FFT
+    of the 1-D kernel are only built when a backend needs them.
+    """
+    def __init__(self, mean, sigma, stateStep, barrier, states):
+        """
+        Args:
+          mean: float, mean of the change in RDV per time step.
+          sigma: float, standard deviation of the change in RDV per time step.
+          stateStep: float, distance between consecutive states.
+          barrier: positive number, magnitude of the (constant) barriers.
+          states: numpy array with the center of each state, as determined by
+              stateStep and barrier.
+        """
+        self.mean = mean
+        self.sigma = sigma
+        self.stateStep = stateStep
+        self.states = states
+        self.numStates = states.size
+        # Probability of crossing the up and down barriers from each state.
+        self.upCrossing = 1 - norm.cdf(barrier - states, mean, sigma)
+        self.downCrossing = norm.cdf(-barrier - states, mean, sigma)
+        self._matrix = None
+        self._weights = None
+        self._directWeights = None
+        self._fftSize = None
+        self._fftWeights = None
+        self._bands = dict()
+
+    @property
+    def matrix(self):
+        """
+        S x S numpy array with the probability of changing from state j to
+        state i, multiplied by stateStep.
+        """
+        if self._matrix is None:
+            changeMatrix = np.subtract(self.states.reshape(self.numStates, 1),
+                                       self.states)
+            self._matrix = self.stateStep * norm.pdf(changeMatrix, self.mean,
+                                                     self.sigma)
+        return self._matrix
+
+    @property
+    def weights(self):
+        """
+        Numpy array of size 2S - 1 with the probability of a change of k
+        states, for k from -(S - 1) to S - 1, multiplied by stateStep.
+        """
+        if self._weights is None:
+            offsets = np.arange(-(self.numStates - 1), self.numStates)
+            self._weights = self.stateStep * norm.pdf(
+                offsets * self.stateStep, self.mean, self.sigma)
+        return self._weights
+
+    @property
+    def directWeights(self):
+        """
+        Tuple (firstOffset, directWeights), where directWeights holds the 1-D
+        kernel for the offsets firstOffset to firstOffset +
+        directWeights.size - 1. Offsets whose weight is below the machine
+        epsilon times the largest weight are left out, since they cannot
+        change the propagated probabilities beyond round-off.
+        """
+        if self._directWeights is None:
+            S = self.numStates
+            kept = np.flatnonzero(self.weights > np.finfo(float).eps *
+                                  self.weights.max())
+            if kept.size == 0:
+                # The whole kernel lies beyond the grid.
+                self._directWeights = (0, np.zeros(1))
+            else:
+                self._directWeights = (
+                    int(kept[0]) - (S - 1),
+                    self.weights[kept[0]:kept[-1] + 1].copy())
+        return self._directWeights
+
+    @property
+    def fftSize(self):
+        """
+        Length of the FFTs, large enough to avoid circular wrap-around when
+        convolving S states with the 2S - 1 kernel offsets.
+        """
+        if self._fftSize is None:
+            self._fftSize = scipy.fft.next_fast_len(3 * self.numStates - 2,
+                                                    real=True)
+        return self._fftSize
+
+    @property
+    def fftWeights(self):
+        """
+        Real FFT of the 1-D kernel, zero-padded to fftSize.
+        """
+        if self._fftWeights is None:
+            self._fftWeights = np.fft.rfft(self.weights, self.fftSize)
+        return self._fftWeights
+
+    def get_band(self, tailTolerance):
+        """
+        Truncates the 1-D kernel to the offsets within k standard deviations
+        of the drift mean, where k is chosen so that each discarded tail has
+        probability mass below tailTolerance / 2.
+        Args:
+          tailTolerance: float, largest probability mass that may be discarded
+              from the kernel.
+        Returns:
+          A tuple (firstOffset, bandWeights, discardedMass), where bandWeights
+              holds the kernel for the offsets firstOffset to firstOffset +
+              bandWeights.size - 1, and discardedMass is the kernel mass, per
+              source state, of the offsets that were left out.
+        """
+        if tailTolerance not in self._bands:
+            S = self.numStates
+            halfWidth = norm.isf(tailTolerance / 2) * self.sigma
+            firstOffset = max(int(np.floor((self.mean - halfWidth) /
+                                           self.stateStep)), -(S - 1))
+            lastOffset = min(int(np.ceil((self.mean + halfWidth) /
+                                         self.stateStep)), S - 1)
+            if lastOffset < firstOffset:
+                # The whole kernel lies beyond the grid.
+                firstOffset = lastOffset = 0
+            band = slice(firstOffset + S - 1, lastOffset + S)
+            bandWeights = self.weights[band].copy()
+            discardedMass = max(self.weights.sum() - bandWeights.sum(), 0.0)
+            self._bands[tailTolerance] = (firstOffset, bandWeights,
+                                          discardedMass)
+        return self._bands[tailTolerance]
+
+    def is_banded(self, tailTolerance):
+        """
+        Checks whether the truncated kernel is narrow enough for banded
+        propagation to pay off.
+        Args:
+          tailTolerance: float, as in get_band.
+        Returns:
+          True if the band covers at most bandedMaxFraction of the states.
+        """
+        bandWeights = self.get_band(tailTolerance)[1]
+        return bandWeights.size <= bandedMaxFraction * self.numStates
+
+    def convolve(self, prStates, firstOffset, weights):
+        """
+        Convolves state probabilities with a truncated 1-D kernel.
+        Args:
+          prStates: numpy array of size S, or G x S numpy array with one state
+              vector per row.
+          firstOffset: integer, state offset of the first kernel weight.
+          weights: numpy array with the kernel weights of consecutive offsets
+              starting at firstOffset.
+        Returns:
+          The propagated state probabilities, with the shape of prStates.
+        """
+        S = self.numStates
+        if prStates.ndim == 1:
+            # Entry i of the result is entry i - firstOffset of the full
+            # convolution with the kernel.
+            start = max(firstOffset, 0)
+            stop = min(S, S + weights.size - 1 + firstOffset)
+            result = np.zeros(S)
+            full = np.convolve(prStates, weights)
+            result[start:stop] = full[start - firstOffset:stop - firstOffset]
+            return result
+        # Stacked state vectors are shifted and added once per offset, so
+        # that all rows are handled by each numpy operation.
+        result = np.zeros(prStates.shape)
+        for offset, weight in zip(range(firstOffset,
+                                        firstOffset + weights.size),
+                                  weights):
+            if abs(offset) >= S:
+                continue
+            if offset >= 0:
+                result[..., offset:] += weight * prStates[..., :S - offset]
+            else:
+                result[..., :S + offset] += weight * prStates[..., -offset:]
+        return result
+
+    def propagate(self, prStates, propagation=u"dense", out=None,
+                  tailTolerance=1e-12):
+        """
+        Applies the transition kernel to state probabilities.
+        Args:
+          prStates: numpy array of size S, or G x S numpy array with one state
+              vector per row.
+          propagation: string, "dense", "direct", "fft" or "banded".
+          out: numpy array with the shape of prStates to store the result in.
+          tailTolerance: float, kernel mass that may be discarded by the
+              "banded" backend, see get_band.
+        Returns:
+          The propagated state probabilities, with the shape of prStates.
+        """
+        S = self.numStates
+        if propagation == u"banded" and not self.is_banded(tailTolerance):
+            propagation = u"dense"
+        if propagation == u"dense":
+            if prStates.ndim == 1:
+                return np.dot(self.matrix, prStates, out=out)
+            return np.dot(prStates, self.matrix.T, out=out)
+        if propagation == u"direct":
+            result = self.convolve(prStates, *self.directWeights)
+        elif propagation == u"banded":
+            firstOffset, bandWeights, _ = self.get_band(tailTolerance)
+            result = self.convolve(prStates, firstOffset, bandWeights)
+        elif propagation == u"fft":
+            result = np.fft.irfft(np.fft.rfft(prStates, self.fftSize,
+                                              axis=-1) * self.fftWeights,
+                                  self.fftSize, axis=-1)[..., S - 1:2 * S - 1]
+            # Round-off in the FFT can leave tiny negative probabilities.
+            np.maximum(result, 0, out=result)
+        else:
+            raise ValueError(u"Error: unknown propagation backend " +
+                             str(propagation) + u".")
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+
+class KernelCache(object):
+    """
+    Least-recently-used cache of the DDM transition kernels used in the
+    likelihood computation. The Gaussian kernel over the state grid and the
+    barrier crossing vectors only depend on the drift mean, sigma, the state
+    step and the barrier, so they can be shared across time steps, trials and
+    models. Since a TransitionKernel builds its dense matrix and FFT lazily,
+    the cache also keeps whatever representations the backends in use need.
+    """
+    def __init__(self, maxSize=64):
+        """
+        Args:
+          maxSize: positive integer, maximum number of kernels held in the
+              cache before the least recently used one is evicted.
+        """
+        if maxSize < 1:
+            raise ValueError("Error: maxSize parameter must be at least one.")
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._kernels = OrderedDict()
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def get_kernel(self, mean, sigma, stateStep, barrier, states):
+        """
+        Returns the transition kernel for a given drift mean, building it if
+        it is not already in the cache.
+        Args:
+          mean: float, mean of the change in RDV per time step.
+          sigma: float, standard deviation of the change in RDV per time step.
+          stateStep: float, distance between consecutive states.
+          barrier: positive number, magnitude of the (constant) barriers.
+          states: numpy array with the center of each state, as determined by
+              stateStep and barrier.
+        Returns:
+          A TransitionKernel object.
+        """
+        key = (mean, sigma, stateStep, barrier)
+        if key in self._kernels:
+            self.hits += 1
+            self._kernels.move_to_end(key)
+            return self._kernels[key]
+
+        self.misses += 1
+        self._kernels[key] = TransitionKernel(mean, sigma, stateStep, barrier,
+                                              states)
+        if len(self._kernels) > self.maxSize:
+            self._kernels.popitem(last=False)
+        return self._kernels[key]
+
+    def get_discarded_mass(self, tailTolerance=1e-12):
+        """
+        Reports the kernel mass discarded by banded propagation.
+        Args:
+          tailTolerance: float, as in TransitionKernel.get_band.
+        Returns:
+          The largest kernel mass, per source state, discarded from any cached
+              kernel that is narrow enough to be propagated as a band. Zero
+              if no such kernel is cached.
+        """
+        discardedMass = 0.0
+        for kernel in self._kernels.values():
+            if kernel.is_banded(tailTolerance):
+                discardedMass = max(discardedMass,
+                                    kernel.get_band(tailTolerance)[2])
+        return discardedMass
+
+    def clear(self):
+        """
+        Empties the cache and resets the hit and miss counters.
+        """
+        self._kernels.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Kernel cache shared by all models in a process, so that each worker of a
+# multiprocessing pool keeps its own copy.
+defaultKernelCache = KernelCache()
+
+
+def get_state_grid(barrier, approxStateStep):
+    """
+    Divides the RDV axis between the barriers into states.
+    Args:
+      barrier: positive number, magnitude of the signal thresholds.
+      approxStateStep: float, approximate size of the bins of the RDV axis.
+    Returns:
+      A tuple (states, stateStep), where states is a numpy array with the
+          center of each state and stateStep is the exact size of the bins.
+    """
+    halfNumStateBins = np.ceil(barrier / approxStateStep)
+    stateStep = barrier / (halfNumStateBins + 0.5)
+    states = np.arange(-barrier + (stateStep / 2),
+                       barrier - (stateStep / 2) + stateStep,
+                       stateStep)
+    return states, stateStep
+
+
+def get_crossing_probabilities_batch(means, numTimeSteps, sigma, barrier,
+                                     bias=0, numNDTSteps=0,
+                                     approxStateStep=0.1, kernelCache=None,
+                                     propagation=u"dense",
+                                     tailTolerance=1e-12):
+    """
+    Propagates the state probabilities of several groups of trials at once and
+    records the probability of crossing each barrier at every time step. Each
+    group corresponds to one drift mean; all trials in a group share the same
+    density evolution, so a single state vector per group is propagated. The
+    state vectors of all groups are stacked and advanced with one batched
+    matrix product per time step, and a group stops being propagated once its
+    own number of time steps is reached.
+    Args:
+      means: numpy array of size G, mean of the change in RDV per time step
+          after non-decision time for each group.
+      numTimeSteps: numpy array of integers of size G, number of time steps
+          needed for each group, i.e. the largest RT // timeStep among the
+          trials of the group.
+      sigma: float, standard deviation of the change in RDV per time step.
+      barrier: positive number, magnitude of the signal thresholds.
+      bias: number, initial value of the decision variable.
+      numNDTSteps: non-negative integer, number of time steps during which the
+          mean of the change in RDV is zero.
+      approxStateStep: float, to be used for binning the RDV axis.
+      kernelCache: KernelCache object holding the transition kernels. Defaults
+          to the cache shared by all models in the process.
+      propagation: string, backend used to propagate the state probabilities,
+          one of propagationMethods. "auto" uses "direct" for grids of fewer
+          than autoFFTNumStates states and "fft" for wider ones.
+      tailTolerance: float, kernel mass that may be discarded when propagation
+          is "banded", see TransitionKernel.get_band.
+    Returns:
+      A tuple (probUpCrossing, probDownCrossing) of G x T numpy arrays, where T
+          is the largest number of time steps. Entry [g, t] is the probability
+          that the RDV of group g crosses the corresponding barrier at time
+          step t. Entries beyond the number of time steps of a group are zero.
+    """
+    if kernelCache is None:
+        kernelCache = defaultKernelCache
+    means = np.asarray(means, dtype=float)
+    numTimeSteps = np.asarray(numTimeSteps, dtype=int)
+    numGroups = means.size
+    maxTimeSteps = int(numTimeSteps.max()) if numGroups else 0
+
+    states, stateStep = get_state_grid(barrier, approxStateStep)
+    biasState = np.argmin(np.absolute(states - bias))
+    outside = (states >= barrier) | (states <= -barrier)
+
+    # Order groups by decreasing number of time steps, so that the groups that
+    # are still being propagated are always the first ones.
+    order = np.argsort(-numTimeSteps, kind=u"stable")
+    sortedSteps = numTimeSteps[order]
+
+    propagation = resolve_propagation(propagation, states.size)
+    ndtKernel = kernelCache.get_kernel(0, sigma, stateStep, barrier, states)
+    driftKernels = [kernelCache.get_kernel(mean, sigma, stateStep, barrier,
+                                           states)
+                    for mean in means[order]]
+    upCrossings = np.stack([kernel.upCrossing for kernel in driftKernels])
+    downCrossings = np.stack([kernel.downCrossing
+                              for kernel in driftKernels])
+    if propagation == u"dense" and numGroups > 0:
+        matrices = np.stack([kernel.matrix for kernel in driftKernels])
+    elif propagation == u"fft" and numGroups > 0:
+        fftWeights = np.stack([kernel.fftWeights for kernel in driftKernels])
+        fftSize = driftKernels[0].fftSize
+
+    prStates = np.zeros((numGroups, states.size))
+    prStates[:, biasState] = 1
+    probUpCrossing = np.zeros((numGroups, maxTimeSteps))
+    probDownCrossing = np.zeros((numGroups, maxTimeSteps))
+
+    numActive = numGroups
+    for time in range(1, maxTimeSteps):
+        while numActive > 0 and sortedSteps[numActive - 1] <= time:
+            numActive -= 1
+        prev = prStates[:numActive]
+
+        if time <= numNDTSteps:
+            prStatesNew = ndtKernel.propagate(prev, propagation,
+                                              tailTolerance=tailTolerance)
+            tempUpCross = np.dot(prev, ndtKernel.upCrossing)
+            tempDownCross = np.dot(prev, ndtKernel.downCrossing)
+        else:
+            if propagation == u"dense":
+                prStatesNew = np.matmul(matrices[:numActive],
+                                        prev[:, :, np.newaxis])[:, :, 0]
+            elif propagation == u"fft":
+                prStatesNew = np.fft.irfft(
+                    np.fft.rfft(prev, fftSize, axis=1) *
+                    fftWeights[:numActive], fftSize,
+                    axis=1)[:, states.size - 1:2 * states.size - 1]
+                np.maximum(prStatesNew, 0, out=prStatesNew)
+            else:
+                prStatesNew = np.stack([
+                    kernel.propagate(row, propagation,
+                                     tailTolerance=tailTolerance)
+                    for kernel, row in zip(driftKernels[:numActive], prev)])
+            tempUpCross = np.einsum(u"gs,gs->g", prev,
+                                    upCrossings[:numActive])
+            tempDownCross = np.einsum(u"gs,gs->g", prev,
+                                      downCrossings[:numActive])
+        prStatesNew[:, outside] = 0
+
+        # Renormalize to cope with numerical approximations.
+        sumIn = np.sum(prev, axis=1)
+        sumCurrent = np.sum(prStatesNew, axis=1) + tempUpCross + tempDownCross
+        scale = sumIn / sumCurrent
+        prStates[:numActive] = prStatesNew * scale[:, np.newaxis]
+        probUpCrossing[order[:numActive], time] = tempUpCross * scale
+        probDownCrossing[order[:numActive], time] = tempDownCross * scale
+
+    return probUpCrossing, probDownCrossing
+
+
+def get_likelihoods_batch(means, numTimeSteps, choices, sigma, barrier,
+                          bias=0, numNDTSteps=0, approxStateStep=0.1,
+                          kernelCache=None, propagation=u"dense",
+                          tailTolerance=1e-12):
+    """
+    Computes the likelihood of a set of DDM trials by grouping them by drift
+    mean and propagating all groups together (see
+    get_crossing_probabilities_batch).
+    Args:
+      means: numpy array of size N, mean of the change in RDV per time step
+          after non-decision time for each trial.
+      numTimeSteps: numpy array of integers of size N, RT // timeStep for each
+          trial.
+      choices: numpy array of size N, either -1 (for left item) or +1 (for
+          right item) for each trial.
+      sigma, barrier, bias, numNDTSteps, approxStateStep, kernelCache,
+          propagation, tailTolerance: same as in
+          get_crossing_probabilities_batch.
+    Returns:
+      A numpy array of size N with the likelihood of each trial.
+    """
+    means = np.asarray(means, dtype=float)
+    numTimeSteps = np.asarray(numTimeSteps, dtype=int)
+    choices = np.asarray(choices)
+    if np.any(numTimeSteps < 1):
+        raise RuntimeError(u"Trial response time is smaller than time step.")
+
+    uniqueMeans, groupIndex = np.unique(means, return_inverse=True)
+    groupTimeSteps = np.zeros(uniqueMeans.size, dtype=int)
+    np.maximum.at(groupTimeSteps, groupIndex, numTimeSteps)
+
+    probUpCrossing, probDownCrossing = get_crossing_probabilities_batch(
+        uniqueMeans, groupTimeSteps, sigma, barrier, bias=bias,
+        numNDTSteps=numNDTSteps, approxStateStep=approxStateStep,
+        kernelCache=kernelCache, propagation=propagation,
+        tailTolerance=tailTolerance)
+    return get_likelihoods_from_crossings(probUpCrossing, probDownCrossing,
+                                          groupIndex, numTimeSteps, choices)
+
+
+def get_likelihoods_from_crossings(probUpCrossing, probDownCrossing,
+                                   groupIndex, numTimeSteps, choices):
+    """
+    Looks up the likelihood of each trial in the barrier crossing
+    probabilities of its group (e.g. its drift value or trial condition). The
+    likelihood of a trial is the probability of crossing the barrier
+    corresponding to its choice at its last time step.
+    Args:
+      probUpCrossing: G x T numpy array, probability of crossing the up
+          barrier at each time step for each group.
+      probDownCrossing: G x T numpy array, same for the down barrier.
+      groupIndex: numpy array of integers of size N, group of each trial.
+      numTimeSteps: numpy array of integers of size N, RT // timeStep for each
+          trial.
+      choices: numpy array of size N, either -1 (for left item) or +1 (for
+          right item) for each trial.
+    Returns:
+      A numpy array of size N with the likelihood of each trial.
+    """
+    groupIndex = np.asarray(groupIndex)
+    numTimeSteps = np.asarray(numTimeSteps, dtype=int)
+    choices = np.asarray(choices)
+    likelihoods = np.zeros(numTimeSteps.size)
+    left = choices == -1
+    right = choices == 1
+    likelihoods[left] = probUpCrossing[groupIndex[left],
+                                       numTimeSteps[left] - 1]
+    likelihoods[right] = probDownCrossing[groupIndex[right],
+                                          numTimeSteps[right] - 1]
+    with np.errstate(invalid=u"ignore"):
+        likelihoods[~(likelihoods > 0)] = 0
+    return likelihoods
+
+
+# Shift of the barriers, in units of sigma per time step, that makes a
+# continuous-time diffusion match a walk whose barrier crossings are only
+# checked at the end of each time step (the continuity correction of Broadie,
+# Glasserman and Kou, 1997; the constant is -zeta(1/2) / sqrt(2 pi)).
+discreteMonitoringShift = 0.5826
+
+
+def get_wiener_fpt_density(t, drift, boundarySeparation, startFraction,
+                           errorTolerance=1e-10):
+    """
+    Computes the first passage time density of a Wiener diffusion process with
+    unit variance at the lower barrier, using the small-time or the large-time
+    series expansion, whichever needs fewer terms for the given error
+    tolerance (Navarro and Fuss, 2009). All arguments are broadcast against
+    each other.
+    Args:
+      t: numpy array, first passage times.
+      drift: numpy array, drift rate of the process.
+      boundarySeparation: numpy array, distance between the barriers.
+      startFraction: numpy array, starting point as a fraction of the distance
+          from the lower to the upper barrier.
+      errorTolerance: float, bound on the truncation error of the series for
+          the normalized density.
+    Returns:
+      A numpy array with the density at each time, zero for t <= 0.
+    """
+    t, drift, a, w = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (t, drift, boundarySeparation,
+                                               startFraction)])
+    density = np.zeros(t.shape)
+    valid = t > 0
+    t, drift, a, w = t[valid], drift[valid], a[valid], w[valid]
+    tt = t / a ** 2
+
+    # Number of terms needed by each expansion.
+    with np.errstate(divide=u"ignore", invalid=u"ignore"):
+        kLarge = np.where(np.pi * tt * errorTolerance < 1,
+                          np.sqrt(-2 * np.log(np.pi * tt * errorTolerance) /
+                                  (np.pi ** 2 * tt)), 0)
+        kLarge = np.maximum(kLarge, 1 / (np.pi * np.sqrt(tt)))
+        smallBound = 2 * np.sqrt(2 * np.pi * tt) * errorTolerance
+        kSmall = np.where(smallBound < 1,
+                          2 + np.sqrt(-2 * tt * np.log(smallBound)), 2)
+        kSmall = np.maximum(kSmall, np.sqrt(tt) + 1)
+    small = kSmall < kLarge
+
+    normalized = np.zeros(tt.shape)
+    if np.any(small):
+        numTerms = int(np.ceil(kSmall[small].max()))
+        k = np.arange(-((numTerms - 1) // 2), (numTerms - 1) // 2 + 2)
+        ttSmall = tt[small, np.newaxis]
+        offsets = w[small, np.newaxis] + 2 * k
+        normalized[small] = (
+            np.sum(offsets * np.exp(-offsets ** 2 / (2 * ttSmall)), axis=1) /
+            np.sqrt(2 * np.pi * tt[small] ** 3))
+    if not np.all(small):
+        numTerms = int(np.ceil(kLarge[~small].max()))
+        k = np.arange(1, numTerms + 1)
+        ttLarge = tt[~small, np.newaxis]
+        normalized[~small] = np.pi * np.sum(
+            k * np.exp(-k ** 2 * np.pi ** 2 * ttLarge / 2) *
+            np.sin(k * np.pi * w[~small, np.newaxis]), axis=1)
+
+    density[valid] = (normalized * np.exp(-drift * a * w - drift ** 2 * t / 2) /
+                      a ** 2)
+    # The truncated series can dip slightly below zero far in the tails.
+    np.maximum(density, 0, out=density)
+    return density
+
+
+def get_likelihoods_analytic(means, numTimeSteps, choices, sigma, barrier,
+                             bias=0, errorTolerance=1e-10):
+    """
+    Computes the likelihood of a set of trials from the first passage time
+    density of the continuous diffusion, instead of iterating over the time
+    steps. Time is measured in time steps, so the drift and the variance per
+    unit time are mean and sigma ** 2, and the density at numTimeSteps - 1
+    approximates the probability of crossing at the time step looked up by
+    get_likelihoods_from_crossings. The barriers are widened by
+    discreteMonitoringShift * sigma to account for crossings only being
+    checked once per time step. The barriers must be constant and the drift
+    must be constant from the first time step, i.e. there is no
+    non-decision time.
+    Args:
+      means: numpy array of size N, mean of the change in RDV per time step
+          for each trial.
+      numTimeSteps: numpy array of integers of size N, RT // timeStep for each
+          trial.
+      choices: numpy array of size N, either -1 (for left item, up barrier) or
+          +1 (for right item, down barrier) for each trial.
+      sigma: float, standard deviation of the change in RDV per time step.
+      barrier: positive number, magnitude of the (constant) barriers.
+      bias: number, starting point of the RDV.
+      errorTolerance: float, bound on the truncation error of the series, see
+          get_wiener_fpt_density.
+    Returns:
+      A numpy array of size N with the likelihood of each trial.
+    """
+    means = np.asarray(means, dtype=float)
+    numTimeSteps = np.asarray(numTimeSteps, dtype=int)
+    choices = np.asarray(choices)
+    shiftedBarrier = barrier + discreteMonitoringShift * sigma
+    boundarySeparation = 2 * shiftedBarrier / sigma
+    startFraction = (bias + shiftedBarrier) / (2 * shiftedBarrier)
+
+    # The density at the up barrier is the density at the down barrier of the
+    # mirrored process.
+    left = choices == -1
+    drift = np.where(left, -means, means) / sigma
+    startFraction = np.where(left, 1 - startFraction, startFraction)
+    likelihoods = get_wiener_fpt_density(numTimeSteps - 1, drift,
+                                         boundarySeparation, startFraction,
+                                         errorTolerance=errorTolerance)
+    likelihoods[~(left | (choices == 1))] = 0
+    return likelihoods
+
+
+def get_seed_sequence(seed=None, *key):
+    """
+    Derives the seed of an independent random stream from a master seed.
+    Child streams are identified by a key, e.g. (modelIndex, conditionIndex),
+    instead of by the order in which they are spawned, so the same stream is
+    obtained in any process and regardless of how the work is split between
+    processes.
+    Args:
+      seed: integer, numpy.random.SeedSequence or None (fresh entropy).
+      key: non-negative integers identifying the child stream, appended to
+          the spawn key of seed.
+    Returns:
+      A numpy.random.SeedSequence object.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    if not key:
+        return seed
+    return np.random.SeedSequence(seed.entropy,
+                                  spawn_key=tuple(seed.spawn_key) + key,
+                                  pool_size=seed.pool_size)
+
+
+def get_condition_rngs(seed, numConditions, firstCondition=0):
+    """
+    Creates one random number generator per trial condition, each seeded with
+    the child stream of seed keyed by the index of the condition.
+    Args:
+      seed: integer or numpy.random.SeedSequence, master seed.
+      numConditions: integer, number of conditions.
+      firstCondition: integer, index of the first condition, for simulating
+          a shard of the conditions with the streams of the full set.
+    Returns:
+      A list of numpy.random.Generator objects.
+    """
+    return [np.random.default_rng(get_seed_sequence(seed, condition))
+            for condition in range(firstCondition,
+                                   firstCondition + numConditions)]
+
+
+def simulate_trials_batch(means, numSimulations, sigma, barrier, bias=0,
+                          numNDTSteps=0, timeStep=10, chunkSize=100,
+                          rng=None, conditionRngs=None,
+                          commonRandomNumbers=False):
+    """
+    Simulates many DDM trials at once. The RDVs of all trials that have not
+    yet crossed a barrier are advanced together, drawing the changes in RDV
+    for chunkSize time steps at a time, instead of one normal draw per trial
+    and time step.
+    Args:
+      means: numpy array of size C, mean of the change in RDV per time step
+          after non-decision time for each trial condition.
+      numSimulations: integer, number of trials to simulate per condition.
+      sigma: float, standard deviation of the change in RDV per time step.
+      barrier: positive number, magnitude of the signal thresholds.
+      bias: number, initial value of the decision variable.
+      numNDTSteps: non-negative integer, number of time steps during which the
+          mean of the change in RDV is zero.
+      timeStep: integer, value in milliseconds used for binning the time axis.
+      chunkSize: positive integer, number of time steps drawn at once for the
+          trials that are still running.
+      rng: numpy.random.Generator used for the draws. Defaults to a freshly
+          seeded generator.
+      conditionRngs: list of C numpy.random.Generator objects, one per
+          condition (see get_condition_rngs). If given, rng is not used and
+          the noise of each condition is drawn from its own generator, so
+          that the simulations of a condition do not depend on which other
+          conditions are simulated with it, or in which process.
+      commonRandomNumbers: boolean, only used with conditionRngs. If set,
+          each chunk of standardized increments is drawn for all
+          numSimulations trials of a condition until all of them have
+          finished, so that the increments of simulation i at time step t
+          only depend on the generator of its condition. Models simulated
+          with generators seeded alike then share their noise, scaled by
+          their sigma and shifted by their drift.
+    Returns:
+      A tuple (RTs, choices) of C x numSimulations numpy arrays with the
+          response time in milliseconds and the choice (-1 for left, +1 for
+          right) of each simulated trial.
+    """
+    if rng is None and conditionRngs is None:
+        rng = np.random.default_rng()
+    means = np.asarray(means, dtype=float)
+    numTrials = means.size * numSimulations
+
+    trialMeans = np.repeat(means, numSimulations)
+    RDV = np.full(numTrials, float(bias))
+    RTs = np.zeros(numTrials, dtype=int)
+    choices = np.zeros(numTrials, dtype=int)
+
+    # Trials that start at or beyond a barrier are over before any change in
+    # RDV is drawn.
+    choices[RDV >= barrier] = -1
+    choices[RDV <= -barrier] = 1
+    active = np.flatnonzero(choices == 0)
+
+    time = 0
+    while active.size > 0:
+        # The mean of the change in RDV is zero during non-decision time.
+        steps = np.arange(time + 1, time + chunkSize + 1)
+        stepMeans = np.where(steps <= numNDTSteps, 0,
+                             trialMeans[active, np.newaxis])
+        if conditionRngs is None:
+            noise = rng.standard_normal((active.size, chunkSize))
+        else:
+            activeConditions = active // numSimulations
+            if commonRandomNumbers:
+                # Only the conditions with active trials are drawn, each for
+                # all of its simulations.
+                conditions, position = np.unique(activeConditions,
+                                                 return_inverse=True)
+                noise = np.empty((conditions.size * numSimulations,
+                                  chunkSize))
+                for i, condition in enumerate(conditions):
+                    noise[i * numSimulations:(i + 1) * numSimulations] = (
+                        conditionRngs[condition].standard_normal(
+                            (numSimulations, chunkSize)))
+                noise = noise[position * numSimulations +
+                              active % numSimulations]
+            else:
+                # The active trials are sorted, so those of each condition
+                # are contiguous.
+                noise = np.empty((active.size, chunkSize))
+                conditions, starts, counts = np.unique(
+                    activeConditions, return_index=True, return_counts=True)
+                for condition, start, count in zip(conditions, starts,
+                                                   counts):
+                    noise[start:start + count] = conditionRngs[
+                        condition].standard_normal((count, chunkSize))
+        paths = RDV[active, np.newaxis] + np.cumsum(
+            stepMeans + sigma * noise, axis=1)
+
+        # Find the first time step in the chunk at which each trial crossed a
+        # barrier, if any.
+        crossedUp = paths >= barrier
+        crossed = crossedUp | (paths <= -barrier)
+        done = crossed.any(axis=1)
+        firstCrossing = np.argmax(crossed, axis=1)[done]
+        finished = active[done]
+        RTs[finished] = (time + firstCrossing + 1) * timeStep
+        choices[finished] = np.where(
+            crossedUp[np.flatnonzero(done), firstCrossing], -1, 1)
+
+        RDV[active] = paths[:, -1]
+        active = active[~done]
+        time += chunkSize
+
+    return (RTs.reshape(means.size, numSimulations),
+            choices.reshape(means.size, numSimulations))
+
+
+def get_propagation_cost(numStates, propagation=u"dense"):
+    """
+    Estimates the relative cost of propagating the state probabilities of one
+    trial condition by one time step.
+    Args:
+      numStates: integer, number of states in the grid.
+      propagation: string, one of propagationMethods.
+    Returns:
+      The estimated number of floating point operations per time step.
+    """
+    propagation = resolve_propagation(propagation, numStates)
+    if propagation == u"fft":
+        fftSize = scipy.fft.next_fast_len(3 * numStates - 2)
+        return 2 * fftSize * np.log2(fftSize)
+    # The direct backend only uses the offsets of the kernel that are not
+    # negligible, which depend on sigma, so its worst case is used, as for the
+    # banded backend, which may fall back to dense.
+    if propagation == u"direct":
+        return numStates * (2 * numStates - 1)
+    return numStates ** 2
+
+
+def schedule_trials(trials, numShards, timeStep=10, numStates=1,
+                    propagation=u"dense"):
+    """
+    Splits trials into shards of balanced cost for the batch likelihood
+    engine. The cost of a trial condition is driven by the number of time
+    steps of its longest trial and by the size of the state grid, so trials
+    with the same condition are kept in the same shard, and the conditions
+    are assigned to shards longest-processing-time first, each going to the
+    shard with the smallest total cost so far.
+    Args:
+      trials: TrialTable object.
+      numShards: int, number of shards.
+      timeStep: integer, value in milliseconds used for binning the time
+          axis.
+      numStates: integer, number of states in the grid, e.g. from
+          get_state_grid.
+      propagation: string, one of propagationMethods.
+    Returns:
+      A tuple (order, shardBounds, shardCosts), where order is a numpy array
+          with the permutation of the trials that makes each shard contiguous,
+          so that shards of trials[order] are given by the list of pairs
+          (start, stop) shardBounds, and shardCosts is a numpy array with the
+          estimated cost of each shard. Per-trial results r computed on
+          trials[order] are put back in the original order by
+          results[order] = r.
+    """
+    _, conditionIndex = trials.group_by_condition()
+    numGroups = conditionIndex.max() + 1 if len(trials) else 0
+    groupSteps = np.zeros(numGroups)
+    np.maximum.at(groupSteps, conditionIndex, trials.RT // timeStep + 1)
+    # Each trial also costs a lookup in the crossing probabilities.
+    groupCosts = (groupSteps * get_propagation_cost(numStates, propagation) +
+                  np.bincount(conditionIndex, minlength=numGroups))
+
+    shardCosts = np.zeros(numShards)
+    groupShards = np.zeros(numGroups, dtype=int)
+    for group in np.argsort(-groupCosts, kind=u"stable"):
+        shard = np.argmin(shardCosts)
+        groupShards[group] = shard
+        shardCosts[shard] += groupCosts[group]
+
+    trialShards = groupShards[conditionIndex]
+    order = np.lexsort((conditionIndex, trialShards))
+    bounds = np.concatenate(
+        [[0], np.cumsum(np.bincount(trialShards, minlength=numShards))])
+    shardBounds = [(int(start), int(stop))
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+    return order, shardBounds, shardCosts
+
+
+# Data shipped once to each worker of a ModelPool by the pool initializer.
+_workerData = dict()
+
+
+def init_worker(data, pidQueue=None):
+    """
+    Initializer for the workers of a ModelPool. Stores the data shared by all
+    tasks in the worker process, so that it is only pickled once per worker.
+    Args:
+      data: dict with the data shared by all tasks.
+      pidQueue: multiprocessing.SimpleQueue to which the worker reports its
+          process id, so that the pool knows all of its workers, including
+          the ones that never get a task.
+    """
+    _workerData.clear()
+    _workerData.update(data)
+    if pidQueue is not None:
+        pidQueue.put(os.getpid())
+
+
+def wrap_worker_method(args):
+    """
+    Wrapper for calling a DDM method on the data held by a ModelPool worker.
+    This method should stay at module level, allowing it to be pickled (as
+    required by multiprocessing).
+    Args:
+      args: a tuple (model, methodName, argNames, shard, kwargs), where model
+          is a DDM object, methodName is the name of the method to be called,
+          argNames is a list with the keys of the worker data to be passed as
+          positional arguments, shard is either None, a pair (start, stop)
+          used to slice the first of these arguments, or a triple (start,
+          stop, numShardedArgs) used to slice the first numShardedArgs of
+          them, and kwargs is a dict with additional keyword arguments.
+    Returns:
+      The output of the method.
+    """
+    model, methodName, argNames, shard, kwargs = args
+    values = [_workerData[name] for name in argNames]
+    if shard is not None:
+        numShardedArgs = shard[2] if len(shard) > 2 else 1
+        for i in range(numShardedArgs):
+            values[i] = values[i][shard[0]:shard[1]]
+    return getattr(model, methodName)(*values, **kwargs)
+
+
+def time_worker_method(args):
+    """
+    Calls wrap_worker_method and measures how long the worker was busy with
+    the task. Used by ModelPool to report the busy and idle time of each
+    worker. This method should stay at module level, allowing it to be pickled
+    (as required by multiprocessing).
+    Args:
+      args: a tuple (model, methodName, argNames, shard, kwargs), see
+          wrap_worker_method.
+    Returns:
+      A tuple (pid, busyTime, output), with the process id of the worker, the
+          time in seconds spent on the task and the output of the method.
+    """
+    start = time.perf_counter()
+    output = wrap_worker_method(args)
+    return os.getpid(), time.perf_counter() - start, output
+
+
+def index_worker_method(indexedArgs):
+    """
+    Calls time_worker_method and tags its output with the index of the task,
+    for methods of ModelPool that return outputs in order of completion. This
+    method should stay at module level, allowing it to be pickled (as required
+    by multiprocessing).
+    Args:
+      indexedArgs: a tuple (taskIndex, args), see wrap_worker_method.
+    Returns:
+      A tuple (taskIndex, (pid, busyTime, output)).
+    """
+    taskIndex, args = indexedArgs
+    return taskIndex, time_worker_method(args)
+
+
+class ModelPool(object):
+    """
+    Long-lived process pool for evaluating many DDM models on the same data
+    set. The data is sent to each worker once, through the pool initializer,
+    so that each task only carries the (small) DDM object and the name of the
+    method to call. Intended to be used as a context manager, which closes
+    the pool and waits for the workers on exit.
+    """
+    def __init__(self, numThreads=4, **data):
+        """
+        Args:
+          numThreads: int, number of worker processes.
+          data: keyword arguments with the data shared by all tasks, e.g.
+              trials=ddmTrials.
+        """
+        self.numThreads = numThreads
+        self.dataSizes = dict((name, len(value))
+                              for name, value in data.items()
+                              if hasattr(value, u"__len__"))
+        # Busy time of each worker and wall time of all calls, in seconds.
+        # Workers report their pid when they start, so that the idle time of
+        # the ones that never got a task is also reported.
+        self.wallTime = 0.0
+        self.busyTimes = dict()
+        self.lastStats = None
+        self._pidQueue = SimpleQueue()
+        self._pool = Pool(numThreads, initializer=init_worker,
+                          initargs=(data, self._pidQueue))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    def map(self, models, methodName, argNames, shard=None, taskKwargs=None,
+            **kwargs):
+        """
+        Calls the same method of several models on the worker data, one task
+        per model.
+        Args:
+          models: list of DDM objects.
+          methodName: string, name of the DDM method to be called.
+          argNames: list of strings, keys of the worker data to be passed as
+              positional arguments to the method.
+          shard: pair (start, stop) used to slice the first of these
+              arguments for all models, or None to pass it whole.
+          taskKwargs: list with a dict of keyword arguments for each model,
+              e.g. its own random seed, added to kwargs.
+          kwargs: additional keyword arguments for the method.
+        Returns:
+          A list with the output of the method for each model.
+        """
+        if taskKwargs is None:
+            taskKwargs = [dict()] * len(models)
+        return self._run(
+            [(model, methodName, argNames, shard, dict(kwargs, **extra))
+             for model, extra in zip(models, taskKwargs)])
+
+    def map_shards(self, model, methodName, argNames, numShards=None,
+                   numShardedArgs=1, shardBounds=None, **kwargs):
+        """
+        Calls a method of one model on contiguous shards of the worker data,
+        one task per shard. The first argument named in argNames is the one
+        split into shards. By default the shards have the same number of
+        items; schedule_trials gives shards of balanced cost instead.
+        Args:
+          model: DDM object.
+          methodName: string, name of the DDM method to be called.
+          argNames: list of strings, keys of the worker data to be passed as
+              positional arguments to the method.
+          numShards: int, number of shards. Defaults to the number of workers.
+          numShardedArgs: int, number of leading arguments in argNames that
+              are split into the same shards, e.g. 2 for the trials and their
+              multiplicities.
+          shardBounds: list of pairs (start, stop) with the shards to use,
+              e.g. from schedule_trials. Overrides numShards.
+          kwargs: additional keyword arguments for the method.
+        Returns:
+          A list with the output of the method for each shard, in order.
+        """
+        if shardBounds is None:
+            if numShards is None:
+                numShards = self.numThreads
+            bounds = np.linspace(0, self.dataSizes[argNames[0]],
+                                 numShards + 1).astype(int)
+            shardBounds = zip(bounds[:-1], bounds[1:])
+        shards = [(start, stop, numShardedArgs)
+                  for start, stop in shardBounds if stop > start]
+        # One shard per task, so that a slow shard does not hold back a
+        # chunk of other shards queued on the same worker.
+        return self._run([(model, methodName, argNames, shard, kwargs)
+                          for shard in shards], chunkSize=1)
+
+    def _run(self, tasks, chunkSize=None):
+        """
+        Runs tasks on the workers and records the busy time of each worker.
+        Args:
+          tasks: list of argument tuples for wrap_worker_method.
+          chunkSize: int, number of tasks sent to a worker at once. Defaults
+              to the chunking of multiprocessing.Pool.map.
+        Returns:
+          A list with the output of each task, in order.
+        """
+        start = time.perf_counter()
+        results = self._pool.map(time_worker_method, tasks, chunkSize)
+        busyTimes = dict((pid, 0.0) for pid in self._get_worker_pids())
+        for pid, busyTime, _ in results:
+            busyTimes[pid] = busyTimes.get(pid, 0.0) + busyTime
+        self._record_times(time.perf_counter() - start, len(tasks), busyTimes)
+        return [output for _, _, output in results]
+
+    def imap_unordered(self, tasks):
+        """
+        Runs tasks on the workers, one task at a time per worker and in the
+        given order, and yields their outputs as they complete. Queueing the
+        most expensive tasks first balances the load of the workers, and the
+        outputs can be handled, e.g. written to disk, while later tasks run.
+        Args:
+          tasks: list of tuples (model, methodName, argNames, kwargs), where
+              model is a DDM object (or any object sent to the workers),
+              methodName is the name of its method to be called, argNames is
+              a list with the keys of the worker data to be passed as
+              positional arguments and kwargs is a dict with additional
+              keyword arguments.
+        Yields:
+          Tuples (taskIndex, output), with the index of the task in tasks and
+              the output of its method, in order of completion.
+        """
+        start = time.perf_counter()
+        busyTimes = dict((pid, 0.0) for pid in self._get_worker_pids())
+        indexedTasks = [(taskIndex, (model, methodName, argNames, None,
+                                     kwargs))
+                        for taskIndex, (model, methodName, argNames, kwargs)
+                        in enumerate(tasks)]
+        for taskIndex, (pid, busyTime, output) in self._pool.imap_unordered(
+                index_worker_method, indexedTasks, 1):
+            busyTimes[pid] = busyTimes.get(pid, 0.0) + busyTime
+            yield taskIndex, output
+        for pid in self._get_worker_pids():
+            busyTimes.setdefault(pid, 0.0)
+        self._record_times(time.perf_counter() - start, len(tasks), busyTimes)
+
+    def _get_worker_pids(self):
+        """
+        Returns:
+          A list with the process ids of the workers that reported so far.
+        """
+        while not self._pidQueue.empty():
+            self.busyTimes.setdefault(self._pidQueue.get(), 0.0)
+        return list(self.busyTimes)
+
+    def _record_times(self, wallTime, numTasks, busyTimes):
+        """
+        Adds the wall time of a call and the busy time of each worker during
+        the call to the totals, and keeps them in lastStats.
+        Args:
+          wallTime: float, wall time of the call in seconds.
+          numTasks: int, number of tasks run in the call.
+          busyTimes: dict indexed by worker process id with the time in
+              seconds spent by each worker on the tasks of the call.
+        """
+        self.wallTime += wallTime
+        for pid, busyTime in busyTimes.items():
+            self.busyTimes[pid] = self.busyTimes.get(pid, 0.0) + busyTime
+        self.lastStats = dict(
+            wallTime=wallTime, numTasks=numTasks,
+            busyTimes=busyTimes,
+            idleTimes=dict((pid, max(wallTime - busyTime, 0.0))
+                           for pid, busyTime in busyTimes.items()))
+
+    def get_worker_times(self):
+        """
+        Gets the busy and idle time of each worker over all the calls to map,
+        map_shards and imap_unordered so far. The same statistics for the
+        last call only are kept in lastStats.
+        Returns:
+          A dict indexed by worker process id, where each entry is a tuple
+              (busyTime, idleTime) in seconds. The idle time is the wall time
+              of the calls minus the busy time, and includes the time spent
+              sending tasks and results between processes.
+        """
+        self._get_worker_pids()
+        return dict((pid, (busyTime, max(self.wallTime - busyTime, 0.0)))
+                    for pid, busyTime in self.busyTimes.items())
+
+    def close(self):
+        """
+        Stops accepting tasks and waits for the workers to exit.
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """
+        Stops the workers immediately, discarding pending tasks.
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+
+def merge_log_likelihoods(partials):
+    """
+    Combines the log-likelihood partials computed on several shards of a data
+    set, e.g. by DDM.get_trials_log_likelihood in each worker.
+    Args:
+      partials: list of tuples (logLikelihood, conditions,
+          conditionLogLikelihoods), where conditions is a K x 5 numpy array of
+          trial conditions and conditionLogLikelihoods a numpy array with the
+          log-likelihood of the trials of each of them in the shard.
+    Returns:
+      A tuple (logLikelihood, conditionLogLikelihoods), with the total
+          log-likelihood and a dict indexed by trial condition with the total
+          log-likelihood of its trials.
+    """
+    logLikelihood = 0.0
+    conditionLogLikelihoods = dict()
+    for shardLogLikelihood, conditions, shardValues in partials:
+        logLikelihood += shardLogLikelihood
+        for row, value in zip(np.asarray(conditions), shardValues):
+            condition = tuple(float(x) for x in row)
+            conditionLogLikelihoods[condition] = (
+                conditionLogLikelihoods.get(condition, 0.0) + float(value))
+    return logLikelihood, conditionLogLikelihoods
+
+
+def parallel_get_likelihoods(model, ddmTrials, timeStep=10, stateStep=0.1,
+                             numThreads=4, pool=None, propagation=u"dense",
+                             tailTolerance=1e-12, deduplicate=True,
+                             reduce=False, schedule=u"cost",
+                             shardBounds=None):
+    """
+    Uses a pool of processes to compute the likelihood of the data from a
+    set of DDM trials given the parameters of a DDM. Each worker computes the
+    likelihoods of a contiguous shard of the trials.
+    Args:
+      model: DDM object, e.g. of ddm_model1 or ddm_model1a.
+      ddmTrials: TrialTable object or list of DDMTrial objects.
+      timeStep: integer, value in milliseconds to be used for binning the
+          time axis.
+      stateStep: float, to be used for binning the RDV axis.
+      numThreads: int, number of processes to be used when no pool is
+          given.
+      pool: ModelPool object whose workers already hold ddmTrials under the
+          name "trials". Reusing the same pool across models avoids starting
+          new processes and sending the trials again for every model. If not
+          given, a temporary pool is created. To skip duplicate trials with a
+          shared pool, send it the unique trials of TrialTable.deduplicate
+          and expand the results.
+      propagation, tailTolerance: backend used to propagate the state
+          probabilities and its tail tolerance, see
+          DDM.get_trial_likelihood.
+      deduplicate: boolean, whether to compute the likelihood of trials
+          with the same trial condition, choice and time step only once
+          when no pool is given. The output is the same either way.
+      reduce: boolean, whether each worker sums the log-likelihoods of its
+          shard (see DDM.get_trials_log_likelihood) instead of returning one
+          likelihood per trial. If a pool is given, the multiplicity of
+          each trial is read from the worker data "counts" when present.
+      schedule: string, how the trials are split into shards when no pool
+          is given. "cost" keeps the trials of each trial condition
+          together and balances the estimated cost of the shards (see
+          schedule_trials), while "contiguous" splits them into shards with
+          the same number of trials. The output is the same either way.
+      shardBounds: list of pairs (start, stop) with the shards of the pool
+          trials, e.g. from schedule_trials. Only used with a pool, where it
+          defaults to shards with the same number of trials; without a pool
+          the shards are given by schedule.
+    Returns:
+      A numpy array of likelihoods obtained for the given trials and model.
+          If reduce is set, a tuple (logLikelihood, conditionLogLikelihoods)
+          instead, with the total log-likelihood and a dict indexed by trial
+          condition with the log-likelihood of its trials.
+    """
+    if pool is None:
+        if shardBounds is not None:
+            raise ValueError(u"Error: shardBounds can only be given with a "
+                             "pool, since the trials sent to a new pool are "
+                             "deduplicated and scheduled first.")
+        trialIndex = None
+        data = dict(trials=ddmTrials)
+        if deduplicate:
+            ddmTrials, trialIndex, counts = TrialTable.from_trials(
+                ddmTrials).deduplicate(timeStep=timeStep)
+            data = dict(trials=ddmTrials, counts=counts)
+        order = None
+        if schedule == u"cost":
+            data[u"trials"] = TrialTable.from_trials(data[u"trials"])
+            numStates = get_state_grid(model.barrier, stateStep)[0].size
+            order, shardBounds, _ = schedule_trials(
+                data[u"trials"], numThreads, timeStep=timeStep,
+                numStates=numStates, propagation=propagation)
+            data = dict((name, value[order])
+                        for name, value in data.items())
+        elif schedule != u"contiguous":
+            raise ValueError(u"Error: schedule must be either cost or "
+                             "contiguous.")
+        with ModelPool(numThreads, **data) as pool:
+            likelihoods = parallel_get_likelihoods(
+                model, data[u"trials"], timeStep=timeStep,
+                stateStep=stateStep, pool=pool, propagation=propagation,
+                tailTolerance=tailTolerance, reduce=reduce,
+                shardBounds=shardBounds)
+        if reduce:
+            return likelihoods
+        if order is not None:
+            likelihoods[order] = likelihoods.copy()
+        if trialIndex is None:
+            return likelihoods
+        return likelihoods[trialIndex]
+
+    if reduce:
+        argNames = [u"trials"]
+        if u"counts" in pool.dataSizes:
+            argNames.append(u"counts")
+        partials = pool.map_shards(
+            model, u"get_trials_log_likelihood", argNames,
+            numShardedArgs=len(argNames), shardBounds=shardBounds,
+            timeStep=timeStep, approxStateStep=stateStep,
+            propagation=propagation, tailTolerance=tailTolerance)
+        return merge_log_likelihoods(partials)
+
+    likelihoods = pool.map_shards(model, u"get_trials_likelihood_batch",
+                                  [u"trials"], shardBounds=shardBounds,
+                                  timeStep=timeStep,
+                                  approxStateStep=stateStep,
+                                  propagation=propagation,
+                                  tailTolerance=tailTolerance)
+    return np.concatenate(likelihoods)
+
+
+def get_posteriors(likelihoods, priors=None, returnTrajectory=False):
+    """
+    Computes the posterior probability of each model after a sequence of
+    trials, updating the posteriors trial by trial with Bayes' rule. The
+    update is done in log space for all trials at once: the log posterior
+    after trial t is the log prior plus the cumulative sum of the log
+    likelihoods up to t, normalized with logsumexp, so that long data sets do
+    not underflow. As in the trial-by-trial update, a trial that has zero
+    likelihood under every model that still has positive posterior
+    probability is skipped.
+    Args:
+      likelihoods: M x N numpy array, likelihood of each of N trials under
+          each of M models.
+      priors: numpy array of size M, prior probability of each model.
+          Defaults to a uniform prior.
+      returnTrajectory: boolean, whether to also return the posteriors after
+          every trial, e.g. for convergence plots.
+    Returns:
+      A numpy array of size M with the posterior probability of each model.
+          If returnTrajectory is set, a tuple (posteriors, trajectory) is
+          returned instead, where trajectory is a M x N numpy array with the
+          posteriors after each trial.
+    """
+    likelihoods = np.asarray(likelihoods, dtype=float)
+    numModels, numTrials = likelihoods.shape
+    if priors is None:
+        priors = np.ones(numModels) / numModels
+    with np.errstate(divide=u"ignore"):
+        logPriors = np.log(np.asarray(priors, dtype=float))
+        logLikelihoods = np.log(likelihoods)
+
+    cumLogLikelihoods = logPriors[:, np.newaxis] + np.cumsum(logLikelihoods,
+                                                             axis=1)
+    # A trial is skipped when it would leave every model with zero posterior
+    # probability. Skipping a trial changes the cumulative sums of the
+    # following ones, so from the first skipped trial on they are accumulated
+    # in a single forward pass, zeroing the log likelihoods of the trials
+    # that would make the running sum all -inf.
+    skipped = np.all(np.isneginf(cumLogLikelihoods), axis=0)
+    if np.any(skipped):
+        first = np.argmax(skipped)
+        running = (cumLogLikelihoods[:, first - 1] if first > 0
+                   else logPriors.copy())
+        for t in range(first, numTrials):
+            updated = running + logLikelihoods[:, t]
+            if np.all(np.isneginf(updated)):
+                logLikelihoods[:, t] = 0
+            else:
+                running = updated
+            cumLogLikelihoods[:, t] = running
+
+    if numTrials == 0:
+        posteriors = np.exp(logPriors - logsumexp(logPriors))
+        trajectory = np.zeros((numModels, 0))
+    else:
+        trajectory = np.exp(cumLogLikelihoods -
+                            logsumexp(cumLogLikelihoods, axis=0))
+        posteriors = trajectory[:, -1]
+    if returnTrajectory:
+        return posteriors, trajectory
+    return posteriors
+
+
+def get_rt_histograms(conditionIndex, RTs, choices, numConditions, histBins):
+    """
+    Builds the response time histograms conditioned on choice for all trial
+    conditions at once, with a single np.bincount over condition-offset bin
+    indices. Bins follow the np.histogram convention: all bins are half-open
+    except the last one, which includes its right edge, and RTs outside the
+    bins are ignored.
+    Args:
+      conditionIndex: numpy array of integers, index of the trial condition
+          of each trial.
+      RTs: numpy array with the response time of each trial.
+      choices: numpy array with the choice of each trial, either -1 (for left
+          item) or +1 (for right item).
+      numConditions: integer, number of trial conditions.
+      histBins: list of numbers corresponding to the edges of the time bins.
+    Returns:
+      A numConditions x B x 2 numpy array of counts, where B is the number of
+          time bins, and the last axis holds the histograms conditioned on
+          left choice (0) and right choice (1).
+    """
+    histBins = np.asarray(histBins)
+    numBins = histBins.size - 1
+    RTs = np.asarray(RTs).ravel()
+    choices = np.asarray(choices).ravel()
+    conditionIndex = np.asarray(conditionIndex).ravel()
+
+    binIndex = np.searchsorted(histBins, RTs, side=u"right") - 1
+    binIndex[RTs == histBins[-1]] = numBins - 1
+    valid = ((binIndex >= 0) & (binIndex < numBins) &
+             ((choices == -1) | (choices == 1)))
+    side = (choices[valid] == 1).astype(int)
+    flatIndex = ((conditionIndex[valid] * numBins + binIndex[valid]) * 2 +
+                 side)
+    counts = np.bincount(flatIndex, minlength=numConditions * numBins * 2)
+    return counts.reshape(numConditions, numBins, 2)
+
+
+def build_data_histograms(trialConditions, dataHistLeft, dataHistRight):
+    """
+    Stacks response time histograms stored in dicts indexed by trial
+    condition into a single integer-indexed array.
+    Args:
+      trialConditions: list of trial conditions.
+      dataHistLeft: dict indexed by trial condition, where each entry is the
+          response time histogram conditioned on left choice.
+      dataHistRight: same as dataHistLeft, for right choice.
+    Returns:
+      A C x B x 2 numpy array with the histograms of each trial condition, in
+          the same layout as the output of get_rt_histograms.
+    """
+    return np.stack([np.column_stack((dataHistLeft[trialCondition],
+                                      dataHistRight[trialCondition]))
+                     for trialCondition in trialConditions])
+
+
+def get_histogram_log_likelihood(simulHists, dataHists):
+    """
+    Computes the log-likelihood of data response time histograms given
+    simulated response time histograms, for all trial conditions at once.
+    Each simulated histogram is normalized separately for each trial
+    condition and choice, and bins with no simulated trials do not
+    contribute to the log-likelihood.
+    Args:
+      simulHists: C x B x 2 numpy array with the simulated histograms.
+      dataHists: C x B x 2 numpy array with the data histograms.
+    Returns:
+      The log-likelihood of the data given the simulated histograms.
+    """
+    totals = np.sum(simulHists, axis=1, keepdims=True)
+    simulProbs = simulHists / np.where(totals != 0, totals, 1)
+    with np.errstate(divide=u"ignore"):
+        logSimulProbs = np.where(simulProbs > 0, np.log(simulProbs), 0)
+    return np.sum(logSimulProbs * dataHists)
+
+
+def get_dataset_key(arrays, settings=None):
+    """
+    Hashes a data set and the settings used to evaluate it, to key the results
+    kept in a ResultStore.
+    Args:
+      arrays: list of numpy arrays (or array-like objects) with the data.
+      settings: dict with the settings that change the results, e.g.
+          {"timeStep": 10, "stateStep": 0.1}.
+    Returns:
+      A string with the hexadecimal SHA-256 digest of the data and settings.
+    """
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode(u"utf-8"))
+        digest.update(array.tobytes())
+    settings = settings if settings else dict()
+    digest.update(repr(sorted((str(name), repr(value))
+                              for name, value in settings.items())
+                       ).encode(u"utf-8"))
+    return digest.hexdigest()
+
+
+class ResultStore(object):
+    """
+    On-disk store of the results of a grid evaluation, e.g. the per-trial
+    likelihoods or the log-likelihood of each model of a grid, so that a run
+    that is stopped can be restarted without evaluating the models again.
+    Results are kept in an SQLite file, indexed by a data set key (see
+    get_dataset_key) and by the model parameters, and each result is
+    committed as soon as it is added. The same file can hold the results of
+    several data sets and settings, and acts as a cache when a data set is
+    evaluated again on an overlapping grid.
+    """
+    def __init__(self, fileName, datasetKey, decimals=12):
+        """
+        Args:
+          fileName: string, name of the SQLite file. Created if it does not
+              exist.
+          datasetKey: string identifying the data set and settings.
+          decimals: int, number of decimals the parameter values are rounded
+              to when used as keys, so that grids built with different
+              floating point operations share their results.
+        """
+        self.fileName = fileName
+        self.datasetKey = datasetKey
+        self.decimals = decimals
+        try:
+            self._connection = sqlite3.connect(fileName)
+            self._connection.execute(
+                u"CREATE TABLE IF NOT EXISTS results (datasetKey TEXT, "
+                "params TEXT, value BLOB, PRIMARY KEY (datasetKey, params))")
+            self._connection.commit()
+        except sqlite3.Error:
+            print(u"An exception occurred while opening result store " +
+                  fileName + u".")
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self._connection.execute(
+            u"SELECT COUNT(*) FROM results WHERE datasetKey = ?",
+            (self.datasetKey,)).fetchone()[0]
+
+    def get_params_key(self, params):
+        """
+        Args:
+          params: sequence of numbers, e.g. the params attribute of a DDM
+              object.
+        Returns:
+          The string used to index the result of params.
+        """
+        return repr(tuple(round(float(value), self.decimals)
+                          for value in params))
+
+    def get(self, params):
+        """
+        Args:
+          params: sequence of numbers, e.g. the params attribute of a DDM
+              object.
+        Returns:
+          The stored result for params as a numpy array (0-dimensional for
+              scalars), or None if there is none.
+        """
+        row = self._connection.execute(
+            u"SELECT value FROM results WHERE datasetKey = ? AND params = ?",
+            (self.datasetKey, self.get_params_key(params))).fetchone()
+        if row is None:
+            return None
+        return np.load(io.BytesIO(row[0]), allow_pickle=False)
+
+    def put(self, params, value):
+        """
+        Adds a result to the store, replacing any previous result for the
+        same parameters, and commits it to disk.
+        Args:
+          params: sequence of numbers, e.g. the params attribute of a DDM
+              object.
+          value: number or numpy array with the result.
+        """
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(value), allow_pickle=False)
+        with self._connection:
+            self._connection.execute(
+                u"INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                (self.datasetKey, self.get_params_key(params),
+                 buffer.getvalue()))
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        self._connection.close()